@@ -32,8 +32,8 @@ HOST_FORMAT = ">IH"
 PORT_FORMAT = ">HHHHH"
 
 class AIRConfig(MacResource):
-  def __init__(self, path):
-    super().__init__(path)
+  def __init__(self, path, data=None):
+    super().__init__(path, data)
     self.name = self.decodeName()
     self.startPort, self.endPort = self.decodePorts()
     self.zones = self.decodeZones()
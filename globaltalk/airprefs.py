@@ -30,8 +30,8 @@ CNID_FORMAT = ">I"
 STRT_FORMAT = ">B"
 
 class AIRPrefs(MacResource):
-  def __init__(self, path):
-    super().__init__(path)
+  def __init__(self, path, data=None):
+    super().__init__(path, data)
     self.filename = self.decodeFile()
     self.cnid = self.decodeCNID()
     self.autostart = self.decodeAutostart()
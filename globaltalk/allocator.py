@@ -0,0 +1,160 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import bisect
+
+SECTOR_SIZE = 512
+
+class VolumeFull(Exception):
+  pass
+
+class VolumeBitmap:
+  def __init__(self, catalog):
+    self.catalog = catalog
+    self.disk = catalog.disk
+    self.mdb = catalog.mdb
+    self.offset = self.mdb.volumeBitmap * SECTOR_SIZE
+    self.bits = bytearray(self.disk.readBytes(self.offset, (self.mdb.blockCount + 7) // 8))
+    self.dirty = set()
+    self.buildIndex()
+    return
+
+  def isUsed(self, block):
+    return bool(self.bits[block // 8] & (0x80 >> (block % 8)))
+
+  def buildIndex(self):
+    # Sorted list of free runs, kept as parallel start/count lists
+    self.starts = []
+    self.counts = []
+    runStart = None
+    block = 0
+    while block < self.mdb.blockCount:
+      value = self.bits[block // 8]
+      if not block % 8 and value in (0x00, 0xff) and block + 8 <= self.mdb.blockCount:
+        used = value == 0xff
+        step = 8
+      else:
+        used = self.isUsed(block)
+        step = 1
+      if used and runStart is not None:
+        self.starts.append(runStart)
+        self.counts.append(block - runStart)
+        runStart = None
+      elif not used and runStart is None:
+        runStart = block
+      block += step
+    if runStart is not None:
+      self.starts.append(runStart)
+      self.counts.append(self.mdb.blockCount - runStart)
+    return
+
+  @property
+  def freeBlocks(self):
+    return sum(self.counts)
+
+  def clumpBlocks(self, blocks, clumpSize=0):
+    clump = max(1, (clumpSize or self.mdb.clumpSize) // self.mdb.blockSize)
+    return (blocks + clump - 1) // clump * clump
+
+  def markRange(self, start, count, used):
+    for block in range(start, start + count):
+      mask = 0x80 >> (block % 8)
+      if used:
+        self.bits[block // 8] |= mask
+      else:
+        self.bits[block // 8] &= ~mask & 0xff
+    first = (start // 8) // SECTOR_SIZE
+    last = ((start + count - 1) // 8) // SECTOR_SIZE
+    self.dirty.update(range(first, last + 1))
+    return
+
+  def take(self, idx, start, count):
+    # Removes start..start+count from the free run at idx
+    runStart, runCount = self.starts[idx], self.counts[idx]
+    del self.starts[idx], self.counts[idx]
+    if start > runStart:
+      self.starts.insert(idx, runStart)
+      self.counts.insert(idx, start - runStart)
+      idx += 1
+    end = start + count
+    if end < runStart + runCount:
+      self.starts.insert(idx, end)
+      self.counts.insert(idx, runStart + runCount - end)
+    self.markRange(start, count, True)
+    return
+
+  def allocate(self, count, near=None, contiguous=False):
+    # Prefers extending right after near, then the smallest free run
+    # that fits, and only splits the request across runs if allowed
+    if near is not None:
+      idx = bisect.bisect_right(self.starts, near) - 1
+      if idx >= 0 and self.starts[idx] <= near \
+         and near + count <= self.starts[idx] + self.counts[idx]:
+        self.take(idx, near, count)
+        return [(near, count)]
+
+    fits = [idx for idx, runCount in enumerate(self.counts) if runCount >= count]
+    if fits:
+      idx = min(fits, key=lambda x: self.counts[x])
+      start = self.starts[idx]
+      self.take(idx, start, count)
+      return [(start, count)]
+
+    if contiguous or self.freeBlocks < count:
+      raise VolumeFull(count, self.freeBlocks)
+
+    extents = []
+    while count:
+      idx = max(range(len(self.counts)), key=lambda x: self.counts[x])
+      start = self.starts[idx]
+      take = min(count, self.counts[idx])
+      self.take(idx, start, take)
+      extents.append((start, take))
+      count -= take
+    return sorted(extents)
+
+  def free(self, extents):
+    for start, count in extents:
+      self.markRange(start, count, False)
+      idx = bisect.bisect_left(self.starts, start)
+      self.starts.insert(idx, start)
+      self.counts.insert(idx, count)
+      if idx + 1 < len(self.starts) and start + count == self.starts[idx + 1]:
+        self.counts[idx] += self.counts[idx + 1]
+        del self.starts[idx + 1], self.counts[idx + 1]
+      if idx > 0 and self.starts[idx - 1] + self.counts[idx - 1] == start:
+        self.counts[idx - 1] += self.counts[idx]
+        del self.starts[idx], self.counts[idx]
+    return
+
+  def flush(self):
+    # Dirty bitmap sectors are written back as contiguous ranges
+    if not self.dirty:
+      return
+    sectors = sorted(self.dirty)
+    rangeStart = previous = sectors[0]
+    for sector in sectors[1:] + [None]:
+      if sector is not None and sector == previous + 1:
+        previous = sector
+        continue
+      start = rangeStart * SECTOR_SIZE
+      end = min((previous + 1) * SECTOR_SIZE, len(self.bits))
+      self.disk.writeBytes(self.offset + start, bytes(self.bits[start:end]))
+      rangeStart = previous = sector
+    self.dirty.clear()
+
+    self.mdb.unusedBlocks = self.freeBlocks
+    self.catalog.writeMDB()
+    return
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .macdisk import HFSDisk
+from .macfork import RESOURCE_FORK
+from .mactcp import MacTCP
+from .airconfig import AIRConfig
+from .airprefs import AIRPrefs
+from .routerconfig import GLOBALTALK_CONFIG, MACTCP_PATH, ROUTER_PATH
+from .clone import COMPANION_FILES
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import csv
+import sys
+import os
+
+IMAGE_SUFFIXES = (".img", ".qcow2", ".hda", ".dsk")
+
+# Report fields in the order they're shown, with their table headings
+FIELDS = (
+  ("image", "Image"),
+  ("ipAddress", "IP"),
+  ("mask", "Mask"),
+  ("gateway", "Gateway"),
+  ("dns", "DNS"),
+  ("name", "Router"),
+  ("startPort", "Start"),
+  ("endPort", "End"),
+  ("zones", "Zones"),
+  ("hosts", "Hosts"),
+  ("configFile", "Config"),
+  ("configCNID", "CNID"),
+  ("autostart", "Autostart"),
+  ("error", "Error"),
+)
+
+def findImages(paths):
+  for path in paths:
+    if not os.path.isdir(path):
+      yield path
+      continue
+    for root, dirs, files in os.walk(path):
+      dirs.sort()
+      for name in sorted(files):
+        if name.endswith(IMAGE_SUFFIXES) and name not in COMPANION_FILES:
+          yield os.path.join(root, name)
+  return
+
+def readResources(disk, macPath):
+  with disk.open(macPath, RESOURCE_FORK) as f:
+    return f.read()
+
+def auditImage(path):
+  # Decodes the router settings straight from the catalog and resource
+  # forks. The image is opened read only and nothing is mounted.
+  report = dict.fromkeys(x[0] for x in FIELDS)
+  report["image"] = path
+
+  try:
+    disk = HFSDisk(path, writable=False)
+  except Exception as e:
+    report["error"] = f"{type(e).__name__}: {e}"
+    return report
+
+  errors = []
+  try:
+    for macPath, decode in ((MACTCP_PATH, auditMacTCP),
+                            (f":{GLOBALTALK_CONFIG}", auditConfig),
+                            (ROUTER_PATH, auditPrefs)):
+      try:
+        decode(report, readResources(disk, macPath))
+      except FileNotFoundError:
+        errors.append(f"{macPath} not found")
+      except Exception as e:
+        errors.append(f"{macPath}: {type(e).__name__}: {e}")
+    if report["configCNID"] is not None:
+      found = disk.catalog.findPath(f":{report['configFile']}")
+      cnid = found[3].data.cnid if found is not None else None
+      if cnid != report["configCNID"]:
+        errors.append(f"Router prefs point at CNID {report['configCNID']},"
+                      f" {report['configFile']} is {cnid}")
+  finally:
+    disk.close()
+  report["error"] = "; ".join(errors) or None
+  return report
+
+def auditMacTCP(report, data):
+  mtcp = MacTCP(None, data=data)
+  report["ipAddress"] = mtcp.ipInfo.ipAddress
+  report["mask"] = mtcp.ipInfo.mask
+  report["gateway"] = mtcp.ipInfo.gateway
+  report["dns"] = [f"{x.ipAddress}:{x.domain}" for x in mtcp.dns]
+  return
+
+def auditConfig(report, data):
+  airconf = AIRConfig(None, data=data)
+  report["name"] = airconf.name
+  report["startPort"] = airconf.startPort
+  report["endPort"] = airconf.endPort
+  report["zones"] = airconf.zones
+  report["hosts"] = airconf.hosts
+  return
+
+def auditPrefs(report, data):
+  airprefs = AIRPrefs(None, data=data)
+  report["configFile"] = airprefs.filename
+  report["configCNID"] = airprefs.cnid
+  report["autostart"] = airprefs.autostart
+  return
+
+def auditImages(paths, jobs=None):
+  # Reports come back in the order of paths
+  with ProcessPoolExecutor(max_workers=jobs) as pool:
+    yield from pool.map(auditImage, paths, chunksize=4)
+  return
+
+def formatValue(value):
+  if value is None:
+    return ""
+  if isinstance(value, list):
+    return ",".join(str(x) for x in value)
+  return str(value)
+
+def printTable(reports, out):
+  rows = [[heading for key, heading in FIELDS]]
+  rows.extend([formatValue(report[key]) for key, heading in FIELDS] for report in reports)
+  widths = [max(len(row[idx]) for row in rows) for idx in range(len(FIELDS))]
+  for row in rows:
+    print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip(), file=out)
+  return
+
+def printCSV(reports, out):
+  writer = csv.writer(out)
+  writer.writerow(key for key, heading in FIELDS)
+  for report in reports:
+    writer.writerow(formatValue(report[key]) for key, heading in FIELDS)
+  return
+
+def build_argparser():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("images", nargs="+", help="HD images, or directories to search for them")
+  parser.add_argument("--format", choices=("table", "json", "csv"), default="table",
+                      help="output format")
+  parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                      help="images to read at once")
+  return parser
+
+def main():
+  args = build_argparser().parse_args()
+
+  reports = list(auditImages(list(findImages(args.images)), args.jobs))
+  if args.format == "json":
+    json.dump(reports, sys.stdout, indent=2)
+    print()
+  elif args.format == "csv":
+    printCSV(reports, sys.stdout)
+  else:
+    printTable(reports, sys.stdout)
+  return int(any(x["error"] for x in reports))
+
+if __name__ == '__main__':
+  exit(main() or 0)
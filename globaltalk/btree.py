@@ -13,7 +13,9 @@
 # GNU General Public License at <http://www.gnu.org/licenses/> for
 # more details.
 
-from dataclasses import dataclass
+from .relstring import CHAR_ORDER, foldName
+
+from dataclasses import dataclass, astuple
 import struct
 
 INDEX_NODE = 0
@@ -26,10 +28,19 @@ FILE_RECORD = 2
 DIR_THREAD = 3
 FILE_THREAD = 4
 
+CATALOG_INDEX_KEY_LENGTH = 0x25
+
+FILE_THREAD_EXISTS = 0x02
+
 FORMAT_NODE = ">II BB HH"
 FORMAT_KEY = ">I32pI"
+FORMAT_KEYPARENT = ">I"
+
+STRUCT_NODE = struct.Struct(FORMAT_NODE)
+STRUCT_KEY = struct.Struct(FORMAT_KEY)
+STRUCT_KEYPARENT = struct.Struct(FORMAT_KEYPARENT)
 
-@dataclass
+@dataclass(slots=True)
 class BTreeNode:
   nextNode: int
   prevNode: int
@@ -38,22 +49,39 @@ class BTreeNode:
   recordCount: int
   reserved: int
   records: tuple
+  offsets: tuple = ()
+  data: bytes = None
 
-@dataclass
+@dataclass(slots=True)
 class IndexEntry:
   parentCNID: int
   name: str
   nodeID: int
 
-@dataclass
+@dataclass(slots=True, repr=False)
 class LeafEntry:
+  # Only the key is decoded when the node is loaded, the record body
+  # is unpacked from the node data the first time it's asked for
   parentCNID: int
   name: str
-  data: bytes
+  nodeData: bytes
+  offset: int
+  _data: object = None
+
+  @property
+  def data(self):
+    if self._data is None:
+      self._data = loadRecord(self.nodeData, self.offset)
+      self.nodeData = None
+    return self._data
+
+  def __repr__(self):
+    return f"LeafEntry(parentCNID={self.parentCNID!r}, name={self.name!r}, data={self.data!r})"
 
 FORMAT_DIRREC = ">HH IIII 16s 16s 16s"
+STRUCT_DIRREC = struct.Struct(FORMAT_DIRREC)
 
-@dataclass
+@dataclass(slots=True)
 class DirectoryRecord:
   flags: int
   count: int
@@ -66,8 +94,9 @@ class DirectoryRecord:
   reserved: bytes
 
 FORMAT_FILEREC = ">BB 16s I H II H IIIII 16s H 12s 12s I"
+STRUCT_FILEREC = struct.Struct(FORMAT_FILEREC)
 
-@dataclass
+@dataclass(slots=True)
 class FileRecord:
   flags: int
   fileType: int
@@ -88,68 +117,167 @@ class FileRecord:
   resourceExtents: bytes
   reserved: int
 
+FORMAT_EXTENT = ">HH"
+EXTENTS_PER_RECORD = 3
+
 FORMAT_THREADREC = ">8s I 32p"
+STRUCT_THREADREC = struct.Struct(FORMAT_THREADREC)
 
-@dataclass
+@dataclass(slots=True)
 class ThreadRecord:
   reserved: bytes
   parentCNID: int
   name: bytes
 
+def decodeExtents(data):
+  extents = []
+  for startBlock, blockCount in struct.iter_unpack(FORMAT_EXTENT, data):
+    if blockCount:
+      extents.append((startBlock, blockCount))
+  return extents
+
+def encodeExtents(extents):
+  extents = list(extents) + [(0, 0)] * (EXTENTS_PER_RECORD - len(extents))
+  return b"".join(struct.pack(FORMAT_EXTENT, *x) for x in extents)
+
+def recordOffset(data, index):
+  pointer = len(data) - (index + 1) * 2
+  return struct.unpack_from(">H", data, pointer)[0]
+
+def recordDataOffset(data, offset):
+  # Leaf record data follows the key, aligned to an even offset
+  pointer = offset + data[offset] + 1
+  return (pointer + 1) // 2 * 2
+
+def encodeRecord(record):
+  if isinstance(record, DirectoryRecord):
+    fmt = STRUCT_DIRREC
+  elif isinstance(record, FileRecord):
+    fmt = STRUCT_FILEREC
+  elif isinstance(record, ThreadRecord):
+    fmt = STRUCT_THREADREC
+  else:
+    raise ValueError("Unhandled record", record)
+  return fmt.pack(*astuple(record))
+
+def loadRecord(data, offset):
+  pointer = recordDataOffset(data, offset)
+  rectype = data[pointer]
+  pointer += 2
+  if rectype == DIR_RECORD:
+    return DirectoryRecord(*STRUCT_DIRREC.unpack_from(data, pointer))
+  elif rectype == FILE_RECORD:
+    return FileRecord(*STRUCT_FILEREC.unpack_from(data, pointer))
+  elif rectype == DIR_THREAD or rectype == FILE_THREAD:
+    return ThreadRecord(*STRUCT_THREADREC.unpack_from(data, pointer))
+  raise ValueError("Unhandled rectype", rectype)
+
+def loadKey(data, offset):
+  parentCNID = STRUCT_KEYPARENT.unpack_from(data, offset+2)[0]
+  nameLen = data[offset+6]
+  return parentCNID, bytes(data[offset+7:offset+7+nameLen])
+
+def keyOrder(parentCNID, name):
+  if isinstance(name, str):
+    name = name.encode("macroman")
+  return parentCNID, foldName(name)
+
+def nodeKeyOrder(data, offset):
+  # Same as keyOrder on loadKey, without making a copy of the name
+  nameLen = data[offset+6]
+  return STRUCT_KEYPARENT.unpack_from(data, offset+2)[0], \
+    data[offset+7:offset+7+nameLen].translate(CHAR_ORDER)
+
+def searchNode(node, key):
+  # Binary search of the raw keys in a node for the last record whose
+  # key is at or before key. Returns its index, or -1 if key sorts
+  # before every record, and whether it is an exact match.
+  key = keyOrder(*key)
+  lo, hi = 0, node.recordCount
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if nodeKeyOrder(node.data, node.offsets[mid]) <= key:
+      lo = mid + 1
+    else:
+      hi = mid
+  idx = lo - 1
+  exact = idx >= 0 and nodeKeyOrder(node.data, node.offsets[idx]) == key
+  return idx, exact
+
+def packCatalogKey(parentCNID, name, index=False):
+  # Index node keys are always padded out to the maximum key length,
+  # leaf keys are only as long as the name and padded to an even length
+  if index:
+    return struct.pack(">BBIB31s", CATALOG_INDEX_KEY_LENGTH, 0, parentCNID, len(name), name)
+  key = struct.pack(">BBIB", 6 + len(name), 0, parentCNID, len(name)) + name
+  if len(key) % 2:
+    key += bytes(1)
+  return key
+
+def packLeafRecord(parentCNID, name, recordType, record):
+  return packCatalogKey(parentCNID, name) + bytes([recordType, 0]) + encodeRecord(record)
+
+def packIndexRecord(parentCNID, name, nodeID):
+  return packCatalogKey(parentCNID, name, index=True) + struct.pack(">I", nodeID)
+
+def indexPointer(record):
+  return struct.unpack_from(">I", record, len(record) - 4)[0]
+
+def splitNode(data):
+  descriptor = list(STRUCT_NODE.unpack_from(data))
+  count = descriptor[4] + 1
+  offsets = struct.unpack_from(f">{count}H", data, len(data) - count * 2)[::-1]
+  records = [bytes(data[offsets[idx]:offsets[idx+1]]) for idx in range(count - 1)]
+  return descriptor, records
+
+def packNode(descriptor, records, nodeSize):
+  # Returns None if the records don't fit in a single node
+  used = STRUCT_NODE.size + sum(len(x) for x in records) + (len(records) + 1) * 2
+  if used > nodeSize:
+    return None
+  data = bytearray(nodeSize)
+  descriptor = list(descriptor)
+  descriptor[4] = len(records)
+  STRUCT_NODE.pack_into(data, 0, *descriptor)
+  offset = STRUCT_NODE.size
+  for idx, record in enumerate(records):
+    struct.pack_into(">H", data, nodeSize - (idx + 1) * 2, offset)
+    data[offset:offset+len(record)] = record
+    offset += len(record)
+  struct.pack_into(">H", data, nodeSize - (len(records) + 1) * 2, offset)
+  return data
+
 def loadBTree(data):
-  size = struct.calcsize(FORMAT_NODE)
-  bt_data = struct.unpack(FORMAT_NODE, data[:size])
-  count = (len(data) - size) // 2
-  records = struct.unpack(f">{count}H", data[size:])[::-1]
-  btree = BTreeNode(*bt_data, records)
-  btree.records = btree.records[:btree.recordCount+1]
+  bt_data = STRUCT_NODE.unpack_from(data)
+  # Only the offsets actually in use are unpacked from the end of the node
+  count = bt_data[4] + 1
+  offsets = struct.unpack_from(f">{count}H", data, len(data) - count * 2)[::-1]
+  btree = BTreeNode(*bt_data, None, offsets)
   if btree.nodeType == HEADER_NODE:
-    btree.records = (loadBTreeHeader(data[records[0]:]),
-                     #data[records[1]:records[1]+128],
-                     #data[records[2]:records[2]+256],
+    btree.records = (loadBTreeHeader(data, offsets[0]),
+                     #data[offsets[1]:offsets[1]+128],
+                     #data[offsets[2]:offsets[2]+256],
                      )
-  elif btree.nodeType == INDEX_NODE:
-    fmtlen = struct.calcsize(FORMAT_KEY)
-    btree.records = [IndexEntry(*struct.unpack(FORMAT_KEY, data[x+2:x+2+fmtlen]))
+    return btree
+
+  # Copy once so lazily decoded records and key searches don't hold on
+  # to a view of the image or of the preloaded catalog
+  data = btree.data = bytes(data)
+  if btree.nodeType == INDEX_NODE:
+    btree.records = [IndexEntry(*STRUCT_KEY.unpack_from(data, x+2))
                      if data[x] else None
-                     for x in btree.records[:-1]]
+                     for x in offsets[:-1]]
   else:
-    fmtlen = struct.calcsize(FORMAT_KEY)
-    records = []
-    for idx in range(len(btree.records) - 1):
-      offset = btree.records[idx]
-      reclen = data[offset]
-      rectotal = btree.records[idx+1] - offset
-      if reclen:
-        record = struct.unpack(FORMAT_KEY, data[offset+2:offset+2+fmtlen])
-        pointer = offset+reclen+1
-        pointer = (pointer + 1) // 2 * 2
-        rectype = data[pointer]
-        recdata = data[pointer:pointer+4]
-        if rectype == DIR_RECORD:
-          dlen = struct.calcsize(FORMAT_DIRREC)
-          pointer += 2
-          recdata = DirectoryRecord(*struct.unpack(FORMAT_DIRREC, data[pointer:pointer+dlen]))
-        elif rectype == FILE_RECORD:
-          dlen = struct.calcsize(FORMAT_FILEREC)
-          pointer += 2
-          recdata = FileRecord(*struct.unpack(FORMAT_FILEREC, data[pointer:pointer+dlen]))
-        elif rectype == DIR_THREAD or rectype == FILE_THREAD:
-          dlen = struct.calcsize(FORMAT_THREADREC)
-          pointer += 2
-          recdata = ThreadRecord(*struct.unpack(FORMAT_THREADREC, data[pointer:pointer+dlen]))
-        else:
-          raise ValueError("Unhandled rectype", rectype)
-        records.append(LeafEntry(*record[:2], recdata))
-      else:
-        records.append(None)
-    btree.records = records
+    btree.records = [LeafEntry(*loadKey(data, offset), data, offset)
+                     if data[offset] else None
+                     for offset in offsets[:-1]]
 
   return btree
 
 FORMAT_HEADER = ">H IIII HH II H I BB I"# 64s"
+STRUCT_HEADER = struct.Struct(FORMAT_HEADER)
 
-@dataclass
+@dataclass(slots=True)
 class BTreeHeader:
   depth: int
   rootNode: int
@@ -167,6 +295,8 @@ class BTreeHeader:
   attributes: int
   #reserved2: bytes
 
-def loadBTreeHeader(data):
-  size = struct.calcsize(FORMAT_HEADER)
-  return BTreeHeader(*struct.unpack(FORMAT_HEADER, data[:size]))
+def loadBTreeHeader(data, offset=0):
+  return BTreeHeader(*STRUCT_HEADER.unpack_from(data, offset))
+
+def encodeBTreeHeader(header):
+  return STRUCT_HEADER.pack(*astuple(header))
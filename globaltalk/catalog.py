@@ -15,30 +15,78 @@
 # GNU General Public License at <http://www.gnu.org/licenses/> for
 # more details.
 
-from .mdb import loadMDB
-from .btree import loadBTree, IndexEntry
-from .macdisk import HFSDisk
+from .mdb import loadMDB, encodeMDB
+from .allocator import VolumeBitmap
+from .btree import loadBTree, loadBTreeHeader, encodeBTreeHeader, IndexEntry
+from .btree import DirectoryRecord, FileRecord, ThreadRecord
+from .btree import recordOffset, recordDataOffset, encodeRecord, loadKey, decodeExtents
+from .btree import packLeafRecord, packIndexRecord, indexPointer, splitNode, packNode
+from .btree import searchNode
+from .btree import STRUCT_NODE, INDEX_NODE, LEAF_NODE, FILE_THREAD, FILE_THREAD_EXISTS
+from .catalogindex import CatalogIndex, ROOT_PARENT_CNID, ROOT_CNID
+from .catalogindex import loadIndexCache, saveIndexCache
+from .catalogcolumns import loadColumns
+from .extents import ExtentsOverflow, ExtentMap, unpackExtent
+from .extents import CATALOG_FILE_CNID, FORK_TYPE_DATA, FORK_TYPE_RESOURCE
+from .macfork import DATA_FORK
+from .verify import verifyCatalog
+from .macdisk import HFSDisk, SECTOR_SIZE
 
+from collections import OrderedDict
 import argparse
 import binascii
+import threading
 import struct
+import time
 
 MDB_START = 2
+NODE_CACHE_SIZE = 128
+MAC_EPOCH_OFFSET = 2082844800
+
+def macTime():
+  # Seconds since 1904 in local time, like the Mac keeps them
+  return int(time.time()) + time.localtime().tm_gmtoff + MAC_EPOCH_OFFSET
+
+class BTreeFull(Exception):
+  pass
 
 class Catalog:
-  def __init__(self, diskObj):
+  def __init__(self, diskObj, cacheSize=NODE_CACHE_SIZE, preload=False):
     self.disk = diskObj
+    self.nodeCache = OrderedDict()
+    self.cacheLock = threading.Lock()
+    self.cacheSize = cacheSize
+    self.cacheHits = 0
+    self.cacheMisses = 0
+    self.preloaded = None
+    self._index = None
+    self._bitmap = None
+    self.touched = False
+    self.indexDirty = False
+    self.extentMaps = {}
     self.mdb = loadMDB(self.disk.readSector(MDB_START))
 
     #print(self.mdb)
     firstBlock = self.disk.readBlock(self.mdb.catalogExtentsRecord1start,
                                      self.mdb.blockSize, self.mdb.extentStart)
-    self.btree = loadBTree(firstBlock)
+    # The allocation block can be bigger than a node, only decode the header node
+    nodeSize = loadBTreeHeader(firstBlock, STRUCT_NODE.size).nodeSize
+    self.btree = loadBTree(firstBlock[:nodeSize])
     #print(self.btree)
 
     self.nodeSize = self.btree.records[0].nodeSize
     self.nodesPerBlock = self.mdb.blockSize // self.nodeSize
 
+    # The catalog can be fragmented past the three extents in the MDB
+    self.overflow = ExtentsOverflow(self.disk, self.mdb)
+    catalogBlocks = -(-self.mdb.catalogFileSize // self.mdb.blockSize)
+    self.catalogMap = ExtentMap(self.overflow.forkExtents(
+      CATALOG_FILE_CNID, FORK_TYPE_DATA,
+      [(self.mdb.catalogExtentsRecord1start, self.mdb.catalogExtentsRecord1count),
+       unpackExtent(self.mdb.catalogExtentsRecord2),
+       unpackExtent(self.mdb.catalogExtentsRecord3)],
+      catalogBlocks))
+
     self.rootNodeID = self.btree.records[0].rootNode
     # print("ROOT NODE")
     # print(self.rootNode)
@@ -46,54 +94,534 @@ class Catalog:
     # print()
     # print("RECURSE")
     # self.recurseChain(self.rootNode)
+
+    if preload:
+      self.preload()
+    return
+
+  @property
+  def header(self):
+    return self.btree.records[0]
+
+  @property
+  def index(self):
+    if self._index is None:
+      path = self.disk.indexCachePath
+      if path is not None:
+        self._index = loadIndexCache(self, path)
+      if self._index is None:
+        self._index = CatalogIndex(self)
+        self.indexDirty = True
+    return self._index
+
+  def saveIndex(self):
+    path = self.disk.indexCachePath
+    if path is not None and self._index is not None and self.indexDirty:
+      saveIndexCache(self._index, path)
+      self.indexDirty = False
+    return
+
+  @property
+  def bitmap(self):
+    if self._bitmap is None:
+      self._bitmap = VolumeBitmap(self)
+    return self._bitmap
+
+  def writeMDB(self):
+    data = bytearray(self.disk.readSector(MDB_START))
+    encoded = encodeMDB(self.mdb)
+    data[:len(encoded)] = encoded
+    self.disk.writeSector(MDB_START, data)
     return
 
+  def touch(self):
+    # The first catalog change bumps the MDB write count so any cached
+    # index of the old catalog no longer matches
+    self.indexDirty = True
+    if self.touched:
+      return
+    self.touched = True
+    self.mdb.writeCount += 1
+    self.mdb.modified = macTime()
+    self.writeMDB()
+    return
+
+  def forkMap(self, record, fork=DATA_FORK):
+    # Cached by the fork's first extent record, so a record that has
+    # been changed gets a new map
+    if fork == DATA_FORK:
+      forkType, inline, allocated = FORK_TYPE_DATA, record.dataExtents, record.dataAllocated
+    else:
+      forkType, inline, allocated = FORK_TYPE_RESOURCE, record.resourceExtents, record.resourceAllocated
+    key = (record.cnid, forkType, inline)
+    extentMap = self.extentMaps.get(key)
+    if extentMap is None:
+      blockCount = -(-allocated // self.mdb.blockSize)
+      extentMap = ExtentMap(self.overflow.forkExtents(record.cnid, forkType,
+                                                      decodeExtents(inline), blockCount))
+      self.extentMaps[key] = extentMap
+    return extentMap
+
   def sectorForNode(self, nodeNum):
-    sector = self.mdb.extentStart + nodeNum \
-      + self.mdb.catalogExtentsRecord1start * self.nodesPerBlock
-    return sector
+    block, delta = divmod(nodeNum, self.nodesPerBlock)
+    physical, _ = self.catalogMap.physicalBlock(block)
+    return self.mdb.extentStart + physical * self.nodesPerBlock + delta
+
+  def preload(self):
+    # Read the whole catalog file in one go, one read per extent. Nodes
+    # are then sliced out of it instead of being read one at a time.
+    self.preloaded = bytearray()
+    remaining = self.mdb.catalogFileSize
+    for startBlock, blockCount in self.catalogMap.extents:
+      length = min(remaining, blockCount * self.mdb.blockSize)
+      offset = self.mdb.extentStart * SECTOR_SIZE + startBlock * self.mdb.blockSize
+      self.preloaded += self.disk.readBytes(offset, length)
+      remaining -= length
+    return
+
+  def readNode(self, nodeNum):
+    start = nodeNum * self.nodeSize
+    if self.preloaded is not None and start + self.nodeSize <= len(self.preloaded):
+      return memoryview(self.preloaded)[start:start+self.nodeSize]
+    return self.disk.readSector(self.sectorForNode(nodeNum))
+
+  def readNodes(self, nodeNums):
+    if self.preloaded is not None:
+      return [self.readNode(x) for x in nodeNums]
+    return self.disk.readSectors(self.sectorForNode(x) for x in nodeNums)
+
+  def writeNode(self, nodeNum, data):
+    start = nodeNum * self.nodeSize
+    if self.preloaded is not None and start + self.nodeSize <= len(self.preloaded):
+      self.preloaded[start:start+self.nodeSize] = data
+    with self.cacheLock:
+      self.nodeCache.pop(nodeNum, None)
+    self.touch()
+    self.disk.writeSector(self.sectorForNode(nodeNum), data)
+    return
 
   def loadNode(self, nodeNum):
-    return loadBTree(self.disk.readSector(self.sectorForNode(nodeNum)))
+    # Safe to call from more than one thread, the node itself is
+    # decoded outside the lock
+    with self.cacheLock:
+      node = self.nodeCache.get(nodeNum)
+      if node is not None:
+        self.nodeCache.move_to_end(nodeNum)
+        self.cacheHits += 1
+        return node
+      self.cacheMisses += 1
+
+    node = loadBTree(self.readNode(nodeNum))
+    with self.cacheLock:
+      self.nodeCache[nodeNum] = node
+      if len(self.nodeCache) > self.cacheSize:
+        self.nodeCache.popitem(last=False)
+    return node
+
+  def siblingLeaves(self, node):
+    # The leaves after node under the same index node, in chain order
+    first = next((x for x in node.records if x is not None), None)
+    if first is None or self.header.depth < 2:
+      return []
+    path, _, _ = self.searchPath((first.parentCNID, first.name))
+    parentID, childIdx = path[-1]
+    return [x.nodeID for x in self.loadNode(parentID).records[childIdx+1:] if x is not None]
+
+  def iterLeaves(self, nodeID=None):
+    # Follows the leaf chain from nodeID, or from the first leaf. Nodes
+    # are decoded directly instead of through loadNode so a full scan
+    # doesn't flush the node cache. Unless the catalog is preloaded,
+    # the rest of a leaf's siblings are read in parallel ahead of time.
+    if nodeID is None:
+      nodeID = self.header.firstLeaf
+    ahead = {}
+    while nodeID:
+      data = ahead.pop(nodeID, None)
+      if data is not None:
+        node = loadBTree(data)
+      else:
+        node = loadBTree(self.readNode(nodeID))
+        if self.preloaded is None:
+          siblings = self.siblingLeaves(node)
+          ahead = dict(zip(siblings, self.readNodes(siblings)))
+      yield nodeID, node
+      nodeID = node.nextNode
+    return
+
+  def walk(self, nodeID=None):
+    # Every leaf record in catalog order
+    for _, node in self.iterLeaves(nodeID):
+      for entry in node.records:
+        if entry is not None:
+          yield entry
+    return
+
+  def leafData(self):
+    # Raw leaf nodes in chain order, nothing is decoded but the links
+    nodeID = self.header.firstLeaf
+    while nodeID:
+      data = self.readNode(nodeID)
+      yield data
+      nodeID = STRUCT_NODE.unpack_from(data)[0]
+    return
+
+  def columns(self, useNumpy=True):
+    # Every file and directory record as columns, see catalogcolumns.
+    # Fastest with the catalog preloaded.
+    return loadColumns(self.leafData(), useNumpy)
+
+  def listdir(self, cnid):
+    # A directory's entries all sort together right after its thread
+    # record, so the walk starts at the leaf that would hold the thread
+    if not self.rootNodeID:
+      return
+    _, nodeID, _ = self.searchPath((cnid, b""))
+    for entry in self.walk(nodeID):
+      if entry.parentCNID > cnid:
+        break
+      if entry.parentCNID == cnid and entry.name:
+        yield entry
+    return
 
   def dumpChain(self, leafNum):
-    node = self.loadNode(leafNum)
-    print(node)
-    if node.nextNode:
-      self.dumpChain(node.nextNode)
+    for _, node in self.iterLeaves(leafNum):
+      print(node)
     return
 
   def recurseChain(self, node, level=0):
-    for record in node.records:
+    stack = [(iter(node.records), level)]
+    while stack:
+      records, level = stack[-1]
+      record = next(records, None)
       if record is None:
-        break
+        stack.pop()
+        continue
       print("  " * level, record)
       if isinstance(record, IndexEntry):
-        self.recurseChain(self.loadNode(record.nodeID), level=level+1)
+        stack.append((iter(self.loadNode(record.nodeID).records), level + 1))
     return
 
   def findNode(self, key, nodeID=None):
     if nodeID is None:
       nodeID = self.rootNodeID
+    while nodeID:
+      node = self.loadNode(nodeID)
+      idx, exact = searchNode(node, key)
+      if node.nodeType != INDEX_NODE:
+        if exact:
+          return nodeID, node, idx, node.records[idx]
+        break
+      if idx < 0:
+        break
+      nodeID = node.records[idx].nodeID
+    return None
+
+  def findPath(self, macPath):
+    # Paths starting with a colon are relative to the root directory,
+    # otherwise the first component is the volume name
+    components = macPath.split(":")
+    if components[0]:
+      parentCNID = ROOT_PARENT_CNID
+    else:
+      parentCNID = ROOT_CNID
+      components = components[1:]
+
+    found = None
+    for name in components:
+      if not name:
+        continue
+      if found is not None:
+        if not isinstance(found[3].data, DirectoryRecord):
+          return None
+        parentCNID = found[3].data.cnid
+      found = self.findNode((parentCNID, name))
+      if found is None:
+        return None
+    return found
+
+  def updateRecord(self, nodeID, index, record):
+    data = bytearray(self.readNode(nodeID))
+    pointer = recordDataOffset(data, recordOffset(data, index))
+    encoded = encodeRecord(record)
+    data[pointer+2:pointer+2+len(encoded)] = encoded
+    self.writeNode(nodeID, data)
+    return
+
+  def writeHeader(self):
+    data = bytearray(self.readNode(0))
+    offset = recordOffset(data, 0)
+    encoded = encodeBTreeHeader(self.header)
+    data[offset:offset+len(encoded)] = encoded
+    self.writeNode(0, data)
+    self.rootNodeID = self.header.rootNode
+    return
+
+  def mapRecords(self):
+    # The node allocation map starts in the header node's third record
+    # and continues in the first record of any map nodes chained after it
+    data = self.readNode(0)
+    yield 0, recordOffset(data, 2), recordOffset(data, 3)
+    nodeID = STRUCT_NODE.unpack_from(data)[0]
+    while nodeID:
+      data = self.readNode(nodeID)
+      yield nodeID, recordOffset(data, 0), recordOffset(data, 1)
+      nodeID = STRUCT_NODE.unpack_from(data)[0]
+    return
+
+  def allocateNode(self):
+    base = 0
+    for mapNodeID, start, end in self.mapRecords():
+      data = bytearray(self.readNode(mapNodeID))
+      for offset in range(start, end):
+        if data[offset] == 0xff:
+          continue
+        for bit in range(8):
+          nodeNum = base + (offset - start) * 8 + bit
+          if nodeNum >= self.header.nodeCount:
+            raise BTreeFull("No free nodes in catalog")
+          if not data[offset] & (0x80 >> bit):
+            data[offset] |= 0x80 >> bit
+            self.writeNode(mapNodeID, data)
+            self.header.freeCount -= 1
+            return nodeNum
+      base += (end - start) * 8
+    raise BTreeFull("No free nodes in catalog")
+
+  def freeNode(self, nodeNum):
+    base = 0
+    for mapNodeID, start, end in self.mapRecords():
+      if nodeNum < base + (end - start) * 8:
+        data = bytearray(self.readNode(mapNodeID))
+        offset = start + (nodeNum - base) // 8
+        data[offset] &= ~(0x80 >> ((nodeNum - base) % 8)) & 0xff
+        self.writeNode(mapNodeID, data)
+        break
+      base += (end - start) * 8
+    self.writeNode(nodeNum, bytes(self.nodeSize))
+    self.header.freeCount += 1
+    return
+
+  def setSiblings(self, nodeID, nextNode=None, prevNode=None):
+    data = bytearray(self.readNode(nodeID))
+    if nextNode is not None:
+      struct.pack_into(">I", data, 0, nextNode)
+    if prevNode is not None:
+      struct.pack_into(">I", data, 4, prevNode)
+    self.writeNode(nodeID, data)
+    return
+
+  def searchPath(self, key):
+    # Walks from the root to the leaf that holds, or would hold, key.
+    # Returns the (nodeID, child index) taken at each index node.
+    path = []
+    nodeID = self.rootNodeID
     node = self.loadNode(nodeID)
-    match = None
-    for idx, record in enumerate(node.records):
-      recordKey = (record.parentCNID, record.name.decode("macroman"))
-      if key == recordKey:
-        return nodeID, node, idx, record
-      if key < recordKey:
+    while node.nodeType == INDEX_NODE:
+      childIdx = max(searchNode(node, key)[0], 0)
+      path.append((nodeID, childIdx))
+      nodeID = node.records[childIdx].nodeID
+      node = self.loadNode(nodeID)
+    return path, nodeID, node
+
+  def insertRecord(self, parentCNID, name, recordType, record):
+    header = self.header
+    if header.freeCount < header.depth + 1:
+      # Worst case every level splits and the root grows
+      raise BTreeFull("Not enough free nodes in catalog")
+
+    raw = packLeafRecord(parentCNID, name, recordType, record)
+    if not header.rootNode:
+      nodeID = self.allocateNode()
+      self.writeNode(nodeID, packNode([0, 0, LEAF_NODE, 1, 0, 0], [raw], self.nodeSize))
+      header.rootNode = header.firstLeaf = header.lastLeaf = nodeID
+      header.depth = 1
+    else:
+      path, nodeID, node = self.searchPath((parentCNID, name))
+      idx, exact = searchNode(node, (parentCNID, name))
+      if exact:
+        raise FileExistsError(parentCNID, name)
+      self.insertIntoNode(path, nodeID, idx + 1, raw)
+
+    header.dataCount += 1
+    self.writeHeader()
+    if self._index is not None:
+      self._index.add(parentCNID, name, record)
+    return
+
+  def insertIntoNode(self, path, nodeID, position, raw):
+    descriptor, records = splitNode(self.readNode(nodeID))
+    records.insert(position, raw)
+    packed = packNode(descriptor, records, self.nodeSize)
+    if packed is not None:
+      self.writeNode(nodeID, packed)
+      if position == 0:
+        self.updateParentKey(path, records[0])
+      return
+
+    # Split roughly in half by size, the upper half moves to a new
+    # node linked in to the right of this one
+    total = sum(len(x) for x in records)
+    split = 1
+    size = len(records[0])
+    while split < len(records) - 1 and size + len(records[split]) <= total // 2:
+      size += len(records[split])
+      split += 1
+    left, right = records[:split], records[split:]
+
+    nextNode, prevNode, nodeType, nodeLevel = descriptor[:4]
+    newID = self.allocateNode()
+    self.writeNode(nodeID, packNode([newID, prevNode, nodeType, nodeLevel, 0, 0],
+                                    left, self.nodeSize))
+    self.writeNode(newID, packNode([nextNode, nodeID, nodeType, nodeLevel, 0, 0],
+                                   right, self.nodeSize))
+    if nextNode:
+      self.setSiblings(nextNode, prevNode=newID)
+    elif nodeType == LEAF_NODE:
+      self.header.lastLeaf = newID
+
+    if position == 0:
+      self.updateParentKey(path, left[0])
+
+    indexRecord = packIndexRecord(*loadKey(right[0], 0), newID)
+    if path:
+      parentID, childIdx = path[-1]
+      self.insertIntoNode(path[:-1], parentID, childIdx + 1, indexRecord)
+    else:
+      rootID = self.allocateNode()
+      rootRecords = [packIndexRecord(*loadKey(left[0], 0), nodeID), indexRecord]
+      self.writeNode(rootID, packNode([0, 0, INDEX_NODE, nodeLevel + 1, 0, 0],
+                                      rootRecords, self.nodeSize))
+      self.header.rootNode = rootID
+      self.header.depth += 1
+      self.rootNodeID = rootID
+    return
+
+  def updateParentKey(self, path, firstRecord):
+    # An index record's key is the first key of the node it points to
+    key = loadKey(firstRecord, 0)
+    for parentID, childIdx in reversed(path):
+      descriptor, records = splitNode(self.readNode(parentID))
+      records[childIdx] = packIndexRecord(*key, indexPointer(records[childIdx]))
+      self.writeNode(parentID, packNode(descriptor, records, self.nodeSize))
+      if childIdx:
         break
-      match = record
+    return
 
-    if isinstance(match, IndexEntry):
-      return self.findNode(key, match.nodeID)
-    return None
+  def deleteRecord(self, parentCNID, name):
+    path, nodeID, node = self.searchPath((parentCNID, name))
+    idx, exact = searchNode(node, (parentCNID, name))
+    if not exact:
+      raise KeyError((parentCNID, name))
+
+    self.removeFromNode(path, nodeID, idx)
+    self.header.dataCount -= 1
+    self.writeHeader()
+    if self._index is not None:
+      self._index.remove(parentCNID, name)
+    return
+
+  def removeFromNode(self, path, nodeID, position):
+    descriptor, records = splitNode(self.readNode(nodeID))
+    del records[position]
+    nextNode, prevNode, nodeType, nodeLevel = descriptor[:4]
+
+    if not records:
+      self.unlinkNode(nodeID, nextNode, prevNode, nodeType)
+      self.freeNode(nodeID)
+      if path:
+        parentID, childIdx = path[-1]
+        self.removeFromNode(path[:-1], parentID, childIdx)
+      else:
+        self.header.rootNode = 0
+        self.header.depth = 0
+        self.header.firstLeaf = self.header.lastLeaf = 0
+        self.rootNodeID = 0
+      return
+
+    self.writeNode(nodeID, packNode(descriptor, records, self.nodeSize))
+    if position == 0 and path:
+      self.updateParentKey(path, records[0])
+
+    if not path:
+      if nodeType == INDEX_NODE and len(records) == 1:
+        # Root has a single child left, the tree loses a level
+        childID = indexPointer(records[0])
+        self.freeNode(nodeID)
+        self.header.rootNode = childID
+        self.header.depth -= 1
+        self.rootNodeID = childID
+      return
+
+    self.mergeSiblings(path, nodeID)
+    return
+
+  def mergeSiblings(self, path, nodeID):
+    # Fold this node into a sibling under the same parent if both fit
+    # in a single node
+    parentID, childIdx = path[-1]
+    descriptor, parentRecords = splitNode(self.readNode(parentID))
+    if childIdx + 1 < len(parentRecords):
+      leftIdx, leftID, rightID = childIdx, nodeID, indexPointer(parentRecords[childIdx + 1])
+    elif childIdx > 0:
+      leftIdx, leftID, rightID = childIdx - 1, indexPointer(parentRecords[childIdx - 1]), nodeID
+    else:
+      return
+
+    leftDescriptor, leftRecords = splitNode(self.readNode(leftID))
+    rightDescriptor, rightRecords = splitNode(self.readNode(rightID))
+    leftDescriptor[0] = rightDescriptor[0]
+    packed = packNode(leftDescriptor, leftRecords + rightRecords, self.nodeSize)
+    if packed is None:
+      return
+
+    self.writeNode(leftID, packed)
+    self.unlinkNode(rightID, rightDescriptor[0], leftID, rightDescriptor[2])
+    self.freeNode(rightID)
+    self.removeFromNode(path[:-1], parentID, leftIdx + 1)
+    return
+
+  def unlinkNode(self, nodeID, nextNode, prevNode, nodeType):
+    if prevNode:
+      self.setSiblings(prevNode, nextNode=nextNode)
+    elif nodeType == LEAF_NODE:
+      self.header.firstLeaf = nextNode
+    if nextNode:
+      self.setSiblings(nextNode, prevNode=prevNode)
+    elif nodeType == LEAF_NODE:
+      self.header.lastLeaf = prevNode
+    return
+
+  def verify(self):
+    return verifyCatalog(self)
+
+  def createFileThread(self, cnid):
+    # Gives a file a thread record so it can be found by CNID. Returns
+    # True if the catalog was changed.
+    parent = self.index.parents.get(cnid)
+    if parent is None:
+      raise FileNotFoundError(cnid)
+    parentCNID, name = parent
+
+    thread = self.index.thread(cnid)
+    if thread is not None:
+      if (thread.parentCNID, thread.name) == parent:
+        return False
+      self.deleteRecord(cnid, b"")
+
+    nodeID, node, idx, entry = self.findNode((parentCNID, name))
+    if not isinstance(entry.data, FileRecord):
+      raise ValueError("Not a file", cnid)
+    entry.data.flags |= FILE_THREAD_EXISTS
+    self.updateRecord(nodeID, idx, entry.data)
+    self.insertRecord(cnid, b"", FILE_THREAD, ThreadRecord(bytes(8), parentCNID, name))
+    return True
 
 def build_argparser():
   parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument("hd", help="HD image to print the catalog of")
   parser.add_argument("cnid", type=int, nargs="?", help="cnid to find")
-  parser.add_argument("--flag", action="store_true", help="flag to do something")
+  parser.add_argument("--preload", action="store_true",
+                      help="read the whole catalog file at once instead of node by node")
   return parser
 
 def hexdump(data):
@@ -107,21 +635,22 @@ def hexdump(data):
 def main():
   args = build_argparser().parse_args()
 
-  disk = HFSDisk(args.hd)
-  catalog = Catalog(disk)
+  disk = HFSDisk(args.hd, mapped=True)
+  catalog = Catalog(disk, preload=args.preload)
 
   if not args.cnid:
-    catalog.recurseChain(catalog.loadNode(catalog.rootNodeID))
+    for entry in catalog.walk():
+      print(entry)
   else:
     node = catalog.findNode((args.cnid, ""))
     print("Found", node)
     if node is not None:
-      data = disk.readSector(catalog.sectorForNode(node[0]))
+      data = catalog.readNode(node[0])
       hexdump(data)
       pointer = (node[2] + 1) * -2
       offset = struct.unpack(">H", data[pointer:pointer+2])[0]
       print(pointer, offset)
-      print(data[offset:])
+      print(bytes(data[offset:]))
 
   return
 
@@ -0,0 +1,148 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .btree import STRUCT_NODE, STRUCT_KEYPARENT, STRUCT_FILEREC, STRUCT_DIRREC
+from .btree import LEAF_NODE, DIR_RECORD, FILE_RECORD, recordDataOffset
+
+from dataclasses import dataclass
+import struct
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Same layouts as FORMAT_FILEREC and FORMAT_DIRREC with the extents
+# split out into their start/count pairs
+STRUCT_FILECOLUMNS = struct.Struct(">BB 16s I H II H IIIII 16s H 6H 6H I")
+STRUCT_DIRCOLUMNS = struct.Struct(">HH I 60x")
+
+if numpy is not None:
+  FILE_DTYPE = numpy.dtype([
+    ("flags", "u1"), ("fileType", "u1"), ("finderInfo", "S16"), ("cnid", ">u4"),
+    ("dataBlock", ">u2"), ("dataSize", ">u4"), ("dataAllocated", ">u4"),
+    ("resourceBlock", ">u2"), ("resourceSize", ">u4"), ("resourceAllocated", ">u4"),
+    ("created", ">u4"), ("modified", ">u4"), ("backup", ">u4"),
+    ("extendedInfo", "S16"), ("clumpSize", ">u2"),
+    ("dataExtents", ">u2", (3, 2)), ("resourceExtents", ">u2", (3, 2)),
+    ("reserved", ">u4"),
+  ])
+  DIR_DTYPE = numpy.dtype([
+    ("flags", ">u2"), ("count", ">u2"), ("cnid", ">u4"), ("rest", "V60"),
+  ])
+
+NO_EXTENTS = ((0, 0),) * 3
+
+@dataclass(slots=True)
+class CatalogColumns:
+  # One entry per file and directory record in catalog order. The
+  # numeric columns are NumPy arrays when NumPy is installed, lists
+  # otherwise. Extents are three (start, count) pairs per record.
+  parentCNID: list
+  name: list
+  recordType: list
+  cnid: list
+  dataSize: list
+  dataAllocated: list
+  resourceSize: list
+  resourceAllocated: list
+  dataExtents: list
+  resourceExtents: list
+
+  def __len__(self):
+    return len(self.name)
+
+def splitLeaves(nodes):
+  # Gathers the file and directory record bodies from raw leaf nodes
+  # without decoding them, along with their keys and catalog position
+  keys = []
+  fileBodies, filePositions = [], []
+  dirBodies, dirPositions = [], []
+  for data in nodes:
+    descriptor = STRUCT_NODE.unpack_from(data)
+    if descriptor[2] != LEAF_NODE:
+      continue
+    count = descriptor[4]
+    offsets = struct.unpack_from(f">{count}H", data, len(data) - count * 2)[::-1]
+    for offset in offsets:
+      if not data[offset]:
+        continue
+      pointer = recordDataOffset(data, offset)
+      rectype = data[pointer]
+      if rectype == FILE_RECORD:
+        fileBodies.append(data[pointer+2:pointer+2+STRUCT_FILEREC.size])
+        filePositions.append(len(keys))
+      elif rectype == DIR_RECORD:
+        dirBodies.append(data[pointer+2:pointer+2+STRUCT_DIRREC.size])
+        dirPositions.append(len(keys))
+      else:
+        continue
+      nameLen = data[offset+6]
+      keys.append((STRUCT_KEYPARENT.unpack_from(data, offset+2)[0],
+                   bytes(data[offset+7:offset+7+nameLen]), rectype))
+  return keys, b"".join(fileBodies), filePositions, b"".join(dirBodies), dirPositions
+
+def numpyColumns(keys, files, filePositions, dirs, dirPositions):
+  fileArray = numpy.frombuffer(files, dtype=FILE_DTYPE)
+  dirArray = numpy.frombuffer(dirs, dtype=DIR_DTYPE)
+  filePositions = numpy.array(filePositions, dtype=numpy.intp)
+  dirPositions = numpy.array(dirPositions, dtype=numpy.intp)
+
+  def column(field, dtype=numpy.uint32):
+    values = numpy.zeros(len(keys), dtype=dtype)
+    values[filePositions] = fileArray[field]
+    if field == "cnid":
+      values[dirPositions] = dirArray[field]
+    return values
+
+  def extents(field):
+    values = numpy.zeros((len(keys), 3, 2), dtype=numpy.uint16)
+    values[filePositions] = fileArray[field]
+    return values
+
+  parents, names, types = zip(*keys) if keys else ((), (), ())
+  return CatalogColumns(numpy.array(parents, dtype=numpy.uint32), list(names),
+                        numpy.array(types, dtype=numpy.uint8), column("cnid"),
+                        column("dataSize"), column("dataAllocated"),
+                        column("resourceSize"), column("resourceAllocated"),
+                        extents("dataExtents"), extents("resourceExtents"))
+
+def listColumns(keys, files, filePositions, dirs, dirPositions):
+  count = len(keys)
+  cnid = [0] * count
+  dataSize, dataAllocated = [0] * count, [0] * count
+  resourceSize, resourceAllocated = [0] * count, [0] * count
+  dataExtents, resourceExtents = [NO_EXTENTS] * count, [NO_EXTENTS] * count
+
+  for position, values in zip(filePositions, STRUCT_FILECOLUMNS.iter_unpack(files)):
+    cnid[position] = values[3]
+    dataSize[position], dataAllocated[position] = values[5], values[6]
+    resourceSize[position], resourceAllocated[position] = values[8], values[9]
+    dataExtents[position] = tuple(zip(values[15:21:2], values[16:21:2]))
+    resourceExtents[position] = tuple(zip(values[21:27:2], values[22:27:2]))
+  for position, values in zip(dirPositions, STRUCT_DIRCOLUMNS.iter_unpack(dirs)):
+    cnid[position] = values[2]
+
+  parents, names, types = (list(x) for x in zip(*keys)) if keys else ([], [], [])
+  return CatalogColumns(parents, names, types, cnid, dataSize, dataAllocated,
+                        resourceSize, resourceAllocated, dataExtents, resourceExtents)
+
+def loadColumns(nodes, useNumpy=True):
+  # Decodes every file and directory record in the given raw nodes in
+  # one go. Anything that isn't a leaf node is skipped.
+  split = splitLeaves(nodes)
+  if useNumpy and numpy is not None:
+    return numpyColumns(*split)
+  return listColumns(*split)
@@ -0,0 +1,159 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .btree import DirectoryRecord, FileRecord, ThreadRecord
+from .relstring import foldName
+
+import json
+import os
+
+ROOT_PARENT_CNID = 1
+ROOT_CNID = 2
+
+INDEX_CACHE_SUFFIX = ".gtidx"
+INDEX_CACHE_VERSION = 1
+
+class CatalogIndex:
+  def __init__(self, catalog, build=True):
+    self.catalog = catalog
+    self.names = {}
+    self.threads = {}
+    self.parents = {}
+    if build:
+      self.build()
+    return
+
+  def build(self):
+    # One pass over the leaf chain
+    self.names.clear()
+    self.threads.clear()
+    self.parents.clear()
+    for entry in self.catalog.walk():
+      self.add(entry.parentCNID, entry.name, entry.data)
+    return
+
+  def add(self, parentCNID, name, record):
+    if isinstance(record, ThreadRecord):
+      self.threads[parentCNID] = record
+    elif isinstance(record, (DirectoryRecord, FileRecord)):
+      self.names[(parentCNID, foldName(name))] = record.cnid
+      self.parents[record.cnid] = (parentCNID, name)
+    return
+
+  def remove(self, parentCNID, name):
+    if not name:
+      self.threads.pop(parentCNID, None)
+      return
+    cnid = self.names.pop((parentCNID, foldName(name)), None)
+    if cnid is not None:
+      self.parents.pop(cnid, None)
+    return
+
+  def lookup(self, parentCNID, name):
+    if isinstance(name, str):
+      name = name.encode("macroman")
+    return self.names.get((parentCNID, foldName(name)))
+
+  def thread(self, cnid):
+    return self.threads.get(cnid)
+
+  def resolve(self, macPath):
+    # Same path rules as Catalog.findPath
+    components = macPath.split(":")
+    if components[0]:
+      cnid = ROOT_PARENT_CNID
+    else:
+      cnid = ROOT_CNID
+      components = components[1:]
+
+    for name in components:
+      if not name:
+        continue
+      cnid = self.lookup(cnid, name)
+      if cnid is None:
+        return None
+    return cnid
+
+  def dump(self):
+    entries = [[parentCNID, name.decode("macroman"), cnid]
+               for cnid, (parentCNID, name) in self.parents.items()]
+    threads = [[cnid, x.parentCNID, x.name.decode("macroman"), x.reserved.hex()]
+               for cnid, x in self.threads.items()]
+    return {"entries": entries, "threads": threads}
+
+  @classmethod
+  def fromDump(cls, catalog, data):
+    index = cls(catalog, build=False)
+    for parentCNID, name, cnid in data["entries"]:
+      name = name.encode("macroman")
+      index.names[(parentCNID, foldName(name))] = cnid
+      index.parents[cnid] = (parentCNID, name)
+    for cnid, parentCNID, name, reserved in data["threads"]:
+      index.threads[cnid] = ThreadRecord(bytes.fromhex(reserved), parentCNID,
+                                         name.encode("macroman"))
+    return index
+
+  def path(self, cnid):
+    components = []
+    while cnid in self.parents:
+      parentCNID, name = self.parents[cnid]
+      components.append(name.decode("macroman"))
+      cnid = parentCNID
+    if cnid != ROOT_PARENT_CNID:
+      return None
+    return ":".join(reversed(components))
+
+def cacheStamp(catalog):
+  # Anything that changes the catalog, us included, bumps the MDB write
+  # count, so these together tell whether a cached index is still good
+  mdb = catalog.mdb
+  header = catalog.header
+  return {
+    "modified": mdb.modified,
+    "writeCount": mdb.writeCount,
+    "catalogFileSize": mdb.catalogFileSize,
+    "rootNode": header.rootNode,
+    "firstLeaf": header.firstLeaf,
+    "lastLeaf": header.lastLeaf,
+    "depth": header.depth,
+    "dataCount": header.dataCount,
+  }
+
+def loadIndexCache(catalog, path):
+  # Returns None if there's no cache or it doesn't match the volume
+  try:
+    with open(path) as f:
+      data = json.load(f)
+  except (OSError, ValueError):
+    return None
+  if data.get("version") != INDEX_CACHE_VERSION or data.get("stamp") != cacheStamp(catalog):
+    return None
+  try:
+    return CatalogIndex.fromDump(catalog, data)
+  except (KeyError, TypeError, ValueError):
+    return None
+
+def saveIndexCache(index, path):
+  data = {"version": INDEX_CACHE_VERSION, "stamp": cacheStamp(index.catalog)}
+  data.update(index.dump())
+  temp = path + ".tmp"
+  try:
+    with open(temp, "w") as f:
+      json.dump(data, f, separators=(",", ":"))
+    os.replace(temp, path)
+  except OSError:
+    # The cache is only an optimization, a read-only directory is fine
+    return False
+  return True
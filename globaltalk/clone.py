@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .catalogindex import INDEX_CACHE_SUFFIX
+
+import argparse
+import shutil
+import fcntl
+import errno
+import os
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+COPY_CHUNK = 8 << 20
+ZERO_BLOCK = 64 << 10
+
+# start-globaltalk looks for these next to the HD image
+COMPANION_FILES = ("pram.img", "Q800.ROM")
+
+def reflink(src, dst):
+  # Returns False if the filesystem can't share extents between files
+  try:
+    fcntl.ioctl(dst, FICLONE, src)
+  except OSError as e:
+    if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+      return False
+    raise
+  return True
+
+def dataRanges(fd, size):
+  # The parts of the file that aren't holes, or all of it if the
+  # filesystem can't say
+  position = 0
+  while position < size:
+    try:
+      start = os.lseek(fd, position, os.SEEK_DATA)
+      end = os.lseek(fd, start, os.SEEK_HOLE)
+    except OSError as e:
+      if e.errno == errno.ENXIO:
+        return
+      if e.errno != errno.EINVAL or position:
+        raise
+      start, end = 0, size
+    except AttributeError:
+      start, end = 0, size
+    yield start, min(end, size)
+    position = end
+  return
+
+def sparseCopy(src, dst):
+  # Copies the data ranges of src, leaving holes in dst wherever src
+  # has holes or whole blocks of zeros
+  size = os.fstat(src).st_size
+  os.ftruncate(dst, size)
+  zeros = bytes(ZERO_BLOCK)
+  for start, end in dataRanges(src, size):
+    for position in range(start, end, COPY_CHUNK):
+      data = memoryview(os.pread(src, min(COPY_CHUNK, end - position), position))
+      for offset in range(0, len(data), ZERO_BLOCK):
+        block = data[offset:offset+ZERO_BLOCK]
+        if block != zeros[:len(block)]:
+          os.pwrite(dst, block, position + offset)
+  return
+
+def cloneFile(src, dst):
+  # Returns True if dst shares src's storage, False if it was copied
+  with open(src, "rb") as fsrc:
+    with open(dst, "xb") as fdst:
+      try:
+        linked = reflink(fsrc.fileno(), fdst.fileno())
+        if not linked:
+          sparseCopy(fsrc.fileno(), fdst.fileno())
+      except BaseException:
+        os.unlink(dst)
+        raise
+  shutil.copymode(src, dst)
+  return linked
+
+def clone(src, dst):
+  # Makes dst a copy of the image at src along with the CNID index
+  # cache and the files start-globaltalk expects beside it. Companion
+  # files already next to dst are left alone. Returns True if every
+  # file was reflinked.
+  linked = cloneFile(src, dst)
+  if os.path.exists(src + INDEX_CACHE_SUFFIX) and not os.path.exists(dst + INDEX_CACHE_SUFFIX):
+    cloneFile(src + INDEX_CACHE_SUFFIX, dst + INDEX_CACHE_SUFFIX)
+
+  srcDir = os.path.dirname(os.path.abspath(src))
+  dstDir = os.path.dirname(os.path.abspath(dst))
+  if srcDir != dstDir:
+    for name in COMPANION_FILES:
+      path = os.path.join(srcDir, name)
+      if os.path.exists(path) and not os.path.exists(os.path.join(dstDir, name)):
+        linked = cloneFile(path, os.path.join(dstDir, name)) and linked
+  return linked
+
+def build_argparser():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("src", help="HD image to clone")
+  parser.add_argument("dst", nargs="+", help="new HD images")
+  return parser
+
+def main():
+  args = build_argparser().parse_args()
+
+  for dst in args.dst:
+    dstDir = os.path.dirname(dst)
+    if dstDir:
+      os.makedirs(dstDir, exist_ok=True)
+    linked = clone(args.src, dst)
+    stored = os.stat(dst).st_blocks * 512
+    print(f"{dst}: {'reflinked' if linked else 'copied'}, {stored} bytes stored")
+  return
+
+if __name__ == '__main__':
+  exit(main() or 0)
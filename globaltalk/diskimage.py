@@ -0,0 +1,155 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+import ctypes
+import errno
+import mmap
+import os
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+ZERO_CHUNK = 1 << 20
+
+def loadFallocate():
+  try:
+    fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+  except (OSError, AttributeError):
+    return None
+  fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+  fallocate.restype = ctypes.c_int
+  return fallocate
+
+FALLOCATE = loadFallocate()
+
+def punchHole(fd, offset, length):
+  # Returns False if the platform or filesystem can't punch holes
+  if FALLOCATE is None or not length:
+    return False
+  if not FALLOCATE(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length):
+    return True
+  err = ctypes.get_errno()
+  if err in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+    return False
+  raise OSError(err, os.strerror(err))
+
+def allocatedBytes(fd, offset, length):
+  # How much of the range is backed by storage in the file. Without
+  # SEEK_DATA support the whole range is assumed to be.
+  end = offset + length
+  total = 0
+  position = offset
+  try:
+    while position < end:
+      try:
+        data = os.lseek(fd, position, os.SEEK_DATA)
+      except OSError as e:
+        if e.errno != errno.ENXIO:
+          raise
+        break
+      if data >= end:
+        break
+      hole = os.lseek(fd, data, os.SEEK_HOLE)
+      total += min(hole, end) - data
+      position = hole
+  except (AttributeError, OSError):
+    return length
+  return total
+
+def openImage(path, mapped=False, writable=True):
+  # Imported here since qcow2 opens its backing files through this
+  from .qcow2 import Qcow2Image, QCOW2_MAGIC
+
+  with open(path, "rb") as f:
+    magic = f.read(len(QCOW2_MAGIC))
+  if magic == QCOW2_MAGIC:
+    return Qcow2Image(path, writable=writable)
+  return RawImage(path, mapped=mapped, writable=writable)
+
+class RawImage:
+  # Byte addressed access to a raw image file. Reads and writes are
+  # positional so one image can be used from several threads at once.
+  format = "raw"
+
+  def __init__(self, path, mapped=False, writable=True):
+    self.path = path
+    self.writable = writable
+    self.stream = open(self.path, "r+b" if writable else "rb")
+    self.fd = self.stream.fileno()
+    self.map = None
+    if mapped:
+      # Reads come back as memoryview slices of the mapped image
+      access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+      self.map = mmap.mmap(self.fd, 0, access=access)
+      self.view = memoryview(self.map)
+    return
+
+  @property
+  def mapped(self):
+    return self.map is not None
+
+  @property
+  def size(self):
+    return os.fstat(self.fd).st_size
+
+  def read(self, offset, length):
+    if self.map is not None:
+      return self.view[offset:offset+length]
+    return os.pread(self.fd, length, offset)
+
+  def write(self, offset, data):
+    if self.map is not None:
+      self.map[offset:offset+len(data)] = data
+      return len(data)
+    data = memoryview(data)
+    written = 0
+    while written < len(data):
+      written += os.pwrite(self.fd, data[written:], offset + written)
+    return written
+
+  def allocated(self, offset, length):
+    return allocatedBytes(self.fd, offset, length)
+
+  def discard(self, offset, length):
+    # The range reads back as zeros afterwards. Chunks that already are
+    # zero aren't rewritten when holes can't be punched.
+    if punchHole(self.fd, offset, length):
+      return
+    end = offset + length
+    for position in range(offset, end, ZERO_CHUNK):
+      count = min(ZERO_CHUNK, end - position)
+      if self.read(position, count) != bytes(count):
+        self.write(position, bytes(count))
+    return
+
+  def flush(self):
+    if not self.writable:
+      return
+    if self.map is not None:
+      self.map.flush()
+    os.fsync(self.fd)
+    return
+
+  def close(self):
+    if self.map is not None:
+      self.view.release()
+      try:
+        self.map.close()
+      except BufferError:
+        # Slices handed out by read are still alive, the mapping goes
+        # away with the last of them
+        pass
+      self.map = None
+    self.stream.close()
+    return
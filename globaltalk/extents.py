@@ -0,0 +1,128 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .btree import STRUCT_NODE, INDEX_NODE, LEAF_NODE, FORMAT_EXTENT, EXTENTS_PER_RECORD
+from .btree import decodeExtents, loadBTreeHeader, recordDataOffset
+
+import bisect
+import struct
+
+SECTOR_SIZE = 512
+
+EXTENTS_FILE_CNID = 3
+CATALOG_FILE_CNID = 4
+
+FORK_TYPE_DATA = 0x00
+FORK_TYPE_RESOURCE = 0xff
+
+FORMAT_EXTENTKEY = ">BBIH"
+STRUCT_EXTENTKEY = struct.Struct(FORMAT_EXTENTKEY)
+EXTENT_RECORD_SIZE = struct.calcsize(FORMAT_EXTENT) * EXTENTS_PER_RECORD
+
+def unpackExtent(value):
+  # The MDB keeps the catalog and extents file extents packed in a u32
+  return value >> 16, value & 0xffff
+
+class ExtentMap:
+  # Maps a fork's logical allocation blocks to volume allocation blocks
+  # by bisecting the logical start of each extent
+  def __init__(self, extents):
+    self.extents = [x for x in extents if x[1]]
+    self.starts = []
+    logical = 0
+    for startBlock, blockCount in self.extents:
+      self.starts.append(logical)
+      logical += blockCount
+    self.blockCount = logical
+    return
+
+  def physicalBlock(self, logicalBlock):
+    # Returns the allocation block and how many blocks follow it in
+    # the same extent
+    if logicalBlock < 0 or logicalBlock >= self.blockCount:
+      raise ValueError("Block past end of fork", logicalBlock)
+    idx = bisect.bisect_right(self.starts, logicalBlock) - 1
+    startBlock, blockCount = self.extents[idx]
+    delta = logicalBlock - self.starts[idx]
+    return startBlock + delta, blockCount - delta
+
+class ExtentsOverflow:
+  def __init__(self, disk, mdb):
+    self.disk = disk
+    self.mdb = mdb
+    self.map = ExtentMap([unpackExtent(mdb.overflowRecord1),
+                          unpackExtent(mdb.overflowRecord2),
+                          unpackExtent(mdb.overflowRecord3)])
+    self.rootNode = 0
+    if self.map.blockCount:
+      data = self.readBytes(0, SECTOR_SIZE)
+      self.header = loadBTreeHeader(data, STRUCT_NODE.size)
+      self.nodeSize = self.header.nodeSize
+      self.rootNode = self.header.rootNode
+    return
+
+  def readBytes(self, offset, length):
+    block, delta = divmod(offset, self.mdb.blockSize)
+    physical, _ = self.map.physicalBlock(block)
+    return self.disk.readBytes(self.mdb.extentStart * SECTOR_SIZE
+                               + physical * self.mdb.blockSize + delta, length)
+
+  def lookup(self, fileID, forkType, startBlock):
+    # Returns the extent record for the fork that starts at startBlock,
+    # or None if there isn't one
+    key = (fileID, forkType, startBlock)
+    nodeID = self.rootNode
+    while nodeID:
+      data = self.readBytes(nodeID * self.nodeSize, self.nodeSize)
+      descriptor = STRUCT_NODE.unpack_from(data)
+      count = descriptor[4]
+      offsets = struct.unpack_from(f">{count}H", data, len(data) - count * 2)[::-1]
+
+      lo, hi = 0, count
+      while lo < hi:
+        mid = (lo + hi) // 2
+        _, recordFork, recordID, recordStart = STRUCT_EXTENTKEY.unpack_from(data, offsets[mid])
+        if (recordID, recordFork, recordStart) <= key:
+          lo = mid + 1
+        else:
+          hi = mid
+      if not lo:
+        return None
+      offset = offsets[lo - 1]
+      pointer = recordDataOffset(data, offset)
+
+      if descriptor[2] == LEAF_NODE:
+        _, recordFork, recordID, recordStart = STRUCT_EXTENTKEY.unpack_from(data, offset)
+        if (recordID, recordFork, recordStart) != key:
+          return None
+        return decodeExtents(data[pointer:pointer+EXTENT_RECORD_SIZE])
+      if descriptor[2] != INDEX_NODE:
+        raise ValueError("Unexpected node in extents file", nodeID, descriptor[2])
+      nodeID = struct.unpack_from(">I", data, pointer)[0]
+    return None
+
+  def forkExtents(self, fileID, forkType, extents, blockCount=None):
+    # Follows a fork's first extent record on into the overflow file
+    # until blockCount blocks are covered, or until there are no more
+    # records if blockCount isn't known
+    extents = [x for x in extents if x[1]]
+    covered = sum(count for start, count in extents)
+    while blockCount is None or covered < blockCount:
+      more = self.lookup(fileID, forkType, covered) if self.rootNode else None
+      if not more:
+        break
+      extents.extend(more)
+      covered += sum(count for start, count in more)
+    return extents
@@ -0,0 +1,94 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .qcow2 import QCOW2_MAGIC
+
+import subprocess
+import struct
+import json
+import os
+
+SECTOR_SIZE = 512
+PROBE_SIZE = 2 * SECTOR_SIZE + 64
+
+VHD_COOKIE = b"conectix"
+VHDX_SIGNATURE = b"vhdxfile"
+UDIF_SIGNATURE = b"koly"
+DRIVER_SIGNATURE = b"ER"
+PARTITION_SIGNATURE = b"PM"
+HFS_SIGNATURE = b"BD"
+HFS_PLUS_SIGNATURE = b"H+"
+HFSX_SIGNATURE = b"HX"
+ISO9660_OFFSET = 32769
+ISO9660_SIGNATURE = b"CD001"
+
+# Disk Copy 4.2 header: name, data size, tag size, checksums, format
+# byte and the 0x0100 private word that marks the format
+FORMAT_DC42 = ">64p II II BB H"
+STRUCT_DC42 = struct.Struct(FORMAT_DC42)
+DC42_MAGIC = 0x0100
+
+def probeFormat(head, tail, size):
+  # Returns the qemu name for the format given the start and the last
+  # sector of the file, or None if it isn't one we know. Disk Copy 4.2
+  # has no qemu driver, so like qemu-img it is reported as raw.
+  if head[:4] == QCOW2_MAGIC:
+    return "qcow2" if struct.unpack_from(">I", head, 4)[0] >= 2 else "qcow"
+  if head[:8] == VHDX_SIGNATURE:
+    return "vhdx"
+  if head[:8] == VHD_COOKIE or tail[:8] == VHD_COOKIE:
+    return "vpc"
+  if tail[:4] == UDIF_SIGNATURE:
+    return "dmg"
+  if len(head) >= STRUCT_DC42.size:
+    _, dataSize, tagSize, _, _, _, _, private = STRUCT_DC42.unpack_from(head)
+    if private == DC42_MAGIC and STRUCT_DC42.size + dataSize + tagSize == size:
+      return "raw"
+  if head[:2] == DRIVER_SIGNATURE and head[SECTOR_SIZE:SECTOR_SIZE+2] == PARTITION_SIGNATURE:
+    return "raw"
+  if head[2*SECTOR_SIZE:2*SECTOR_SIZE+2] in (HFS_SIGNATURE, HFS_PLUS_SIGNATURE, HFSX_SIGNATURE):
+    return "raw"
+  return None
+
+def probeImage(path):
+  # Identifies an image from its headers without starting qemu-img
+  with open(path, "rb") as f:
+    fd = f.fileno()
+    st = os.fstat(fd)
+    size = st.st_size
+    head = os.pread(fd, PROBE_SIZE, 0)
+    tail = os.pread(fd, SECTOR_SIZE, size - SECTOR_SIZE) if size >= SECTOR_SIZE else b""
+    imageFormat = probeFormat(head, tail, size)
+    if imageFormat is None and os.pread(fd, len(ISO9660_SIGNATURE),
+                                        ISO9660_OFFSET) == ISO9660_SIGNATURE:
+      imageFormat = "raw"
+  if imageFormat is None:
+    return None
+  return {"filename": path, "format": imageFormat, "actual-size": st.st_blocks * 512}
+
+def qemuImageInfo(path):
+  cmd = ["qemu-img", "info", "--output=json", path]
+  process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+  pstr = process.stdout.read()
+  process.stdout.close()
+  process.wait()
+  if isinstance(pstr, bytes):
+    pstr = str(pstr, "utf-8")
+  return json.loads(pstr)
+
+def imageInfo(path):
+  # qemu-img info style results, only asking qemu-img about formats
+  # that can't be told from their headers
+  return probeImage(path) or qemuImageInfo(path)
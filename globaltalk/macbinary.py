@@ -22,6 +22,8 @@ import os
 import argparse
 
 FORMAT_MACBIN = ">B 64p 4s4s B B HHHB B IIIIHB 14s IHBBH"
+MACBIN_HEADER_SIZE = 128
+MACBIN_VERSION = 129
 
 @dataclass
 class MacBinaryHeader:
@@ -49,6 +51,30 @@ class MacBinaryHeader:
   minVersion: int
   crc: int
 
+def headerForFileRecord(name, record):
+  finderInfo = record.finderInfo
+  return MacBinaryHeader(
+    0, name.encode("macroman"), finderInfo[0:4], finderInfo[4:8],
+    finderInfo[8], 0,
+    *struct.unpack(">HHH", finderInfo[10:16]),
+    record.flags & 1, 0,
+    record.dataSize, record.resourceSize, record.craeted, record.modified,
+    0, finderInfo[9], bytes(14),
+    0, 0, MACBIN_VERSION, MACBIN_VERSION, 0,
+  )
+
+def packHeader(header):
+  hlen = struct.calcsize(FORMAT_MACBIN)
+  data = struct.pack(FORMAT_MACBIN, *astuple(header))
+
+  crc16 = crcmod.predefined.mkPredefinedCrcFun("xmodem")
+  header.crc = crc16(data[:hlen-2])
+  data = data[:hlen-2] + struct.pack(">H", header.crc) + bytes([0] * MACBIN_HEADER_SIZE)
+  return data[:MACBIN_HEADER_SIZE]
+
+def paddedLength(length):
+  return (length + MACBIN_HEADER_SIZE - 1) // MACBIN_HEADER_SIZE * MACBIN_HEADER_SIZE
+
 class MacBinary:
   def __init__(self, path):
     self.path = path
@@ -68,17 +94,21 @@ class MacBinary:
     return
 
   def save(self):
-    hlen = struct.calcsize(FORMAT_MACBIN)
-    data = struct.pack(FORMAT_MACBIN, *astuple(self.header))
-
-    crc16 = crcmod.predefined.mkPredefinedCrcFun("xmodem")
-    self.header.crc = crc16(data[:hlen-2])
-    data = data[:hlen-2] + struct.pack(">H", self.header.crc) + bytes([0] * 128)
-    data = data[:128]
+    data = packHeader(self.header)
     with open(self.path, "r+b") as f:
       f.write(data)
     return
 
+  def readForks(self):
+    # Data fork follows the header, resource fork follows the data
+    # fork, each padded out to a multiple of 128 bytes
+    with open(self.path, "rb") as f:
+      f.seek(MACBIN_HEADER_SIZE + paddedLength(self.header.secondHeaderLen), 0)
+      dataFork = f.read(self.header.dataLen)
+      f.seek(paddedLength(f.tell()), 0)
+      resourceFork = f.read(self.header.resourceLen)
+    return dataFork, resourceFork
+
 def build_argparser():
   parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument("file", help="file to print MacBinary header")
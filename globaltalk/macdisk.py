@@ -14,17 +14,41 @@
 # more details.
 
 from .partition import loadPartition
+from .btree import FileRecord
+from .macfork import MacFork, ForkFull, DATA_FORK
+from .allocator import VolumeFull
+from .catalogindex import INDEX_CACHE_SUFFIX
+from .diskimage import openImage
+from .overlay import OverlayImage
+from .trim import trimDisk
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import subprocess
+import dataclasses
+import threading
 
 SECTOR_SIZE = 512
+IO_WORKERS = 8
 
 class HFSDisk:
-  def __init__(self, path):
+  def __init__(self, path, mapped=False, indexCache=False, delta=None, writable=True):
     self.path = path
-    self.stream = open(self.path, "r+b")
-    self.stream.seek(SECTOR_SIZE, 0)
-    partitionMap = loadPartition(self.stream.read(SECTOR_SIZE))
+    self.delta = delta
+    if delta is not None:
+      # The image at path is only read, changes go to the delta file
+      self.image = OverlayImage(path, delta, mapped=mapped)
+    else:
+      self.image = openImage(path, mapped=mapped, writable=writable)
+    # The CNID index is kept in a file next to the image between runs
+    self.indexCachePath = None
+    if indexCache:
+      self.indexCachePath = (delta or path) + INDEX_CACHE_SUFFIX
+    # Guards the staged sectors, image I/O itself is positional and
+    # safe to do from several threads at once
+    self.lock = threading.RLock()
+    self.pool = None
+    partitionMap = loadPartition(self.readImage(SECTOR_SIZE, SECTOR_SIZE))
     if partitionMap.signature != 0x504d:
       raise ValueError("Not a valid Apple Partition Map")
     partition = partitionMap
@@ -34,32 +58,183 @@ class HFSDisk:
       if ptype == "Apple_HFS":
         found = True
         break
-      partition = loadPartition(self.stream.read(SECTOR_SIZE))
+      partition = loadPartition(self.readImage((idx + 2) * SECTOR_SIZE, SECTOR_SIZE))
     if not found:
       raise ValueError("Unable to find HFS partition")
     self.volumeOffset = partition.partitionStart
+    self._catalog = None
+    self.staged = None
     return
 
+  @property
+  def catalog(self):
+    if self._catalog is None:
+      # Imported here since catalog.py imports HFSDisk for its CLI
+      from .catalog import Catalog
+      self._catalog = Catalog(self)
+    return self._catalog
+
+  def readImage(self, offset, length):
+    return self.image.read(offset, length)
+
+  def writeImage(self, offset, data):
+    return self.image.write(offset, data)
+
+  def readBytes(self, offset, length):
+    data = self.readImage(self.volumeOffset * SECTOR_SIZE + offset, length)
+    if not self.staged:
+      return data
+
+    first = offset // SECTOR_SIZE
+    last = (offset + length - 1) // SECTOR_SIZE
+    with self.lock:
+      overlay = [(x, bytes(buf)) for x, buf in self.staged.items() if first <= x <= last]
+    if not overlay:
+      return data
+    data = bytearray(data)
+    for sector, buf in overlay:
+      start = sector * SECTOR_SIZE
+      lo = max(start, offset)
+      hi = min(start + SECTOR_SIZE, offset + length)
+      data[lo-offset:hi-offset] = buf[lo-start:hi-start]
+    return bytes(data)
+
+  def writeBytes(self, offset, data):
+    if self.staged is None:
+      return self.writeImage(self.volumeOffset * SECTOR_SIZE + offset, data)
+
+    end = offset + len(data)
+    with self.lock:
+      for sector in range(offset // SECTOR_SIZE, (end - 1) // SECTOR_SIZE + 1):
+        start = sector * SECTOR_SIZE
+        buf = self.staged.get(sector)
+        if buf is None:
+          buf = bytearray(self.readBytes(start, SECTOR_SIZE))
+        lo = max(start, offset)
+        hi = min(start + SECTOR_SIZE, end)
+        buf[lo-start:hi-start] = data[lo-offset:hi-offset]
+        self.staged[sector] = buf
+    return len(data)
+
   def readSector(self, sector):
-    offset = (sector + self.volumeOffset) * SECTOR_SIZE
-    #print("Reading:", hex(offset))
-    self.stream.seek(offset, 0)
-    return self.stream.read(SECTOR_SIZE)
+    return self.readBytes(sector * SECTOR_SIZE, SECTOR_SIZE)
 
   def writeSector(self, sector, data):
-    offset = (sector + self.volumeOffset) * SECTOR_SIZE
-    #print("Writing:", hex(offset))
-    self.stream.seek(offset, 0)
-    return self.stream.write(data)
+    return self.writeBytes(sector * SECTOR_SIZE, data)
+
+  def readSectors(self, sectors):
+    # Independent sectors are fetched concurrently, which pays off when
+    # the image is on network storage. A mapped image is already in
+    # memory so there's nothing to gain from threads.
+    sectors = list(sectors)
+    if self.image.mapped or len(sectors) < 2:
+      return [self.readSector(x) for x in sectors]
+    if self.pool is None:
+      self.pool = ThreadPoolExecutor(max_workers=IO_WORKERS)
+    return list(self.pool.map(self.readSector, sectors))
 
   def readBlock(self, blockNum, blockSize, baseSector):
-    base = (baseSector + self.volumeOffset) * SECTOR_SIZE
-    offset = (blockNum * blockSize) + base
-    #print("Block:", blockNum, hex(offset))
-    self.stream.seek(offset, 0)
-    return self.stream.read(blockSize)
+    return self.readBytes(baseSector * SECTOR_SIZE + blockNum * blockSize, blockSize)
+
+  @contextmanager
+  def transaction(self):
+    # Writes are staged in memory and only reach the image, in sector
+    # order and with a single fsync, once the block exits cleanly
+    self.staged = {}
+    try:
+      yield self
+    except BaseException:
+      self.staged = None
+      self._catalog = None
+      raise
+    self.flush()
+    self.staged = None
+    return
+
+  def flush(self):
+    if self.staged:
+      for sector in sorted(self.staged):
+        self.writeImage((sector + self.volumeOffset) * SECTOR_SIZE, self.staged[sector])
+      self.staged.clear()
+    self.image.flush()
+    if self._catalog is not None:
+      self._catalog.saveIndex()
+    return
+
+  def reload(self):
+    # Call after something outside this object has modified the image
+    self._catalog = None
+    return
+
+  def blockOffset(self, blockNum):
+    mdb = self.catalog.mdb
+    return mdb.extentStart * SECTOR_SIZE + blockNum * mdb.blockSize
+
+  def findFile(self, macPath):
+    found = self.catalog.findPath(macPath)
+    if found is None or not isinstance(found[3].data, FileRecord):
+      raise FileNotFoundError(macPath)
+    return found
+
+  def open(self, macPath, fork=DATA_FORK):
+    nodeID, node, index, entry = self.findFile(macPath)
+    return MacFork(self, entry.data, fork)
+
+  def writeForks(self, macPath, forks):
+    # Forks are rewritten through their existing extents, new blocks
+    # are only allocated for forks that grew. Nothing is written unless
+    # every fork fits.
+    nodeID, node, index, entry = self.findFile(macPath)
+    record = dataclasses.replace(entry.data)
+    streams = [(MacFork(self, record, fork), data) for fork, data in forks.items()]
+    added = []
+    try:
+      for stream, data in streams:
+        added.extend(stream.grow(len(data)))
+    except (ForkFull, VolumeFull):
+      self.catalog.bitmap.free(added)
+      raise
+    for stream, data in streams:
+      stream.replace(data)
+    self.catalog.updateRecord(nodeID, index, record)
+    if added:
+      self.catalog.bitmap.flush()
+    return
+
+  def writeFork(self, macPath, data, fork=DATA_FORK):
+    return self.writeForks(macPath, {fork: data})
+
+  def close(self):
+    if self._catalog is not None and not self.staged:
+      self._catalog.saveIndex()
+    if self.pool is not None:
+      self.pool.shutdown()
+      self.pool = None
+    self.image.close()
+    return
+
+  def commitOverlay(self):
+    # Folds the delta into the image it overlays
+    self.flush()
+    self.image.commit()
+    self.reload()
+    return
+
+  def exportOverlay(self, path):
+    # Saves the delta as a qcow2 image backed by the base image
+    self.flush()
+    self.image.exportQcow2(path)
+    return
+
+  def trim(self, dryRun=False):
+    return trimDisk(self, dryRun=dryRun)
 
   def mount(self):
+    # hfsutils works on the image file, so anything staged has to land first
+    if self.image.format != "raw":
+      raise ValueError("hfsutils only works on raw images", self.path)
+    if self.staged:
+      self.flush()
     cmd = ["hmount", self.path]
     subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return
@@ -67,4 +242,5 @@ class HFSDisk:
   def unmount(self):
     cmd = ["humount"]
     subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    self.reload()
     return
@@ -13,7 +13,9 @@
 # GNU General Public License at <http://www.gnu.org/licenses/> for
 # more details.
 
-from .macbinary import MacBinary
+from .macbinary import MacBinary, headerForFileRecord, packHeader
+from .macdisk import HFSDisk
+from .macfork import ForkFull, DATA_FORK, RESOURCE_FORK
 
 import subprocess
 import tempfile
@@ -26,32 +28,85 @@ class UnmountFailed(Exception):
   pass
 
 class MacFile:
-  def __init__(self, diskPath, macPath, dataPath=None):
+  def __init__(self, diskPath, macPath, dataPath=None, disk=None):
     self.diskPath = diskPath
     self.macPath = macPath
     self._dataPath = dataPath
+    self.disk = disk
+    return
+
+  def openDisk(self):
+    if self.disk is not None:
+      return self.disk
+    return HFSDisk(self.diskPath)
+
+  def closeDisk(self, disk):
+    if disk is not self.disk:
+      disk.close()
     return
 
   def load(self):
     self.temp = tempfile.TemporaryDirectory()
-
-    cmd1 = ["hcopy", "-m", self.macPath, "-"]
-    cmd2 = ["macunpack", "-f"]
+    filename = self.macPath.rsplit(":", 1)[-1]
 
     if self._dataPath:
-      with open(self._dataPath, "rb") as f:
-        proc2 = subprocess.Popen(cmd2, stdin=f, cwd=self.temp.name)
-        proc2.wait()
+      macbin = MacBinary(self._dataPath)
+      info = packHeader(macbin.header)
+      dataFork, resourceFork = macbin.readForks()
     else:
-      self.mount()
-      proc1 = subprocess.Popen(cmd1, stdout=subprocess.PIPE)
-      proc2 = subprocess.Popen(cmd2, stdin=proc1.stdout, cwd=self.temp.name)
-      proc2.wait()
-      self.unmount()
-
+      disk = self.openDisk()
+      try:
+        nodeID, node, index, entry = disk.findFile(self.macPath)
+        info = packHeader(headerForFileRecord(filename, entry.data))
+        with disk.open(self.macPath, DATA_FORK) as f:
+          dataFork = f.read()
+        with disk.open(self.macPath, RESOURCE_FORK) as f:
+          resourceFork = f.read()
+      finally:
+        self.closeDisk(disk)
+
+    basePath = os.path.join(self.temp.name, filename.replace("/", ":"))
+    for extension, data in ((".info", info), (".data", dataFork), (".rsrc", resourceFork)):
+      with open(basePath + extension, "wb") as f:
+        f.write(data)
     return
 
+  def matchesDisk(self, disk, forks):
+    try:
+      nodeID, node, index, entry = disk.findFile(self.macPath)
+    except FileNotFoundError:
+      return False
+    if (entry.data.dataSize, entry.data.resourceSize) != \
+       (len(forks[DATA_FORK]), len(forks[RESOURCE_FORK])):
+      return False
+    for fork, data in forks.items():
+      with disk.open(self.macPath, fork) as f:
+        if f.read() != data:
+          return False
+    return True
+
   def save(self):
+    # Returns False if the file on disk already had these forks
+    forks = {}
+    for fork, path in ((DATA_FORK, self.dataPath), (RESOURCE_FORK, self.resourcePath)):
+      forks[fork] = b""
+      if path:
+        with open(path, "rb") as f:
+          forks[fork] = f.read()
+
+    disk = self.openDisk()
+    try:
+      if self.matchesDisk(disk, forks):
+        return False
+      disk.writeForks(self.macPath, forks)
+      return True
+    except (FileNotFoundError, ForkFull):
+      # File doesn't exist yet or can't grow without the extents
+      # overflow file, let hfsutils create or reallocate it
+      pass
+    finally:
+      self.closeDisk(disk)
+
     header = MacBinary(self.infoPath)
     header.updateDataLength(self.dataPath)
     header.updateResourceLength(self.resourcePath)
@@ -67,14 +122,20 @@ class MacFile:
     proc2 = subprocess.Popen(cmd2, stdin=proc1.stdout, cwd=self.temp.name)
     proc2.wait()
     self.unmount()
-    return
+    return True
 
   def mount(self):
+    if self.disk is not None:
+      self.disk.mount()
+      return
     cmd = ["hmount", self.diskPath]
     subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return
 
   def unmount(self):
+    if self.disk is not None:
+      self.disk.unmount()
+      return
     cmd = ["humount"]
     subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return
@@ -101,9 +162,11 @@ class MacFile:
 
   @property
   def catalogID(self):
-    self.mount()
-    cmd = ["hls", "-id", self.macPath]
-    p = subprocess.run(cmd, capture_output=True, text=True)
-    self.unmount()
-    cnid = int(p.stdout.strip().split()[0])
+    disk = self.openDisk()
+    try:
+      cnid = disk.catalog.index.resolve(self.macPath)
+    finally:
+      self.closeDisk(disk)
+    if cnid is None:
+      raise FileNotFoundError(self.macPath)
     return cnid
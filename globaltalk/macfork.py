@@ -0,0 +1,150 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .btree import encodeExtents, EXTENTS_PER_RECORD
+from .extents import ExtentMap
+
+import io
+import os
+
+DATA_FORK = "data"
+RESOURCE_FORK = "rsrc"
+
+class ForkFull(Exception):
+  pass
+
+class MacFork(io.RawIOBase):
+  def __init__(self, disk, record, fork=DATA_FORK):
+    super().__init__()
+    self.disk = disk
+    self.record = record
+    self.fork = fork
+    self.blockSize = disk.catalog.mdb.blockSize
+
+    if fork == DATA_FORK:
+      self.length = record.dataSize
+    elif fork == RESOURCE_FORK:
+      self.length = record.resourceSize
+    else:
+      raise ValueError("Unknown fork", fork)
+
+    self.map = disk.catalog.forkMap(record, fork)
+    self.extents = self.map.extents
+    self.allocated = self.map.blockCount * self.blockSize
+    if self.allocated < self.length:
+      raise ValueError("Fork extents don't cover its length", self.allocated, self.length)
+
+    self.position = 0
+    return
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def tell(self):
+    return self.position
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_SET:
+      position = offset
+    elif whence == os.SEEK_CUR:
+      position = self.position + offset
+    elif whence == os.SEEK_END:
+      position = self.length + offset
+    else:
+      raise ValueError("Invalid whence", whence)
+    if position < 0:
+      raise ValueError("Negative seek position", position)
+    self.position = position
+    return self.position
+
+  def physicalRun(self, position):
+    # Returns volume byte offset and contiguous length for a fork position
+    block, delta = divmod(position, self.blockSize)
+    physical, blockCount = self.map.physicalBlock(block)
+    return self.disk.blockOffset(physical) + delta, blockCount * self.blockSize - delta
+
+  def readinto(self, buffer):
+    view = memoryview(buffer).cast("B")
+    remaining = min(len(view), self.length - self.position)
+    done = 0
+    while remaining > 0:
+      offset, runLength = self.physicalRun(self.position)
+      count = min(remaining, runLength)
+      view[done:done+count] = self.disk.readBytes(offset, count)
+      self.position += count
+      done += count
+      remaining -= count
+    return done
+
+  def grow(self, length):
+    # Allocates blocks so the fork can hold length bytes, extending the
+    # last extent in place when the blocks after it are free
+    if length <= self.allocated:
+      return []
+    if len(self.extents) > EXTENTS_PER_RECORD:
+      # Already continues in the extents overflow file, which is only
+      # ever read
+      raise ForkFull(self.fork, "uses extents overflow file")
+    bitmap = self.disk.catalog.bitmap
+    needed = (length - self.allocated + self.blockSize - 1) // self.blockSize
+    needed = bitmap.clumpBlocks(needed, self.record.clumpSize)
+
+    near = None
+    if self.extents:
+      near = self.extents[-1][0] + self.extents[-1][1]
+    added = bitmap.allocate(needed, near=near)
+
+    extents = list(self.extents)
+    for startBlock, blockCount in added:
+      if extents and extents[-1][0] + extents[-1][1] == startBlock:
+        extents[-1] = (extents[-1][0], extents[-1][1] + blockCount)
+      else:
+        extents.append((startBlock, blockCount))
+    if len(extents) > EXTENTS_PER_RECORD:
+      bitmap.free(added)
+      raise ForkFull(self.fork, "needs extents overflow file")
+
+    self.map = ExtentMap(extents)
+    self.extents = self.map.extents
+    self.allocated = self.map.blockCount * self.blockSize
+    if self.fork == DATA_FORK:
+      self.record.dataExtents = encodeExtents(extents)
+      self.record.dataAllocated = self.allocated
+    else:
+      self.record.resourceExtents = encodeExtents(extents)
+      self.record.resourceAllocated = self.allocated
+    return added
+
+  def replace(self, data):
+    if len(data) > self.allocated:
+      raise ForkFull(self.fork, len(data), self.allocated)
+
+    position = 0
+    while position < len(data):
+      offset, runLength = self.physicalRun(position)
+      count = min(len(data) - position, runLength)
+      self.disk.writeBytes(offset, data[position:position+count])
+      position += count
+
+    self.length = len(data)
+    if self.fork == DATA_FORK:
+      self.record.dataSize = self.length
+    else:
+      self.record.resourceSize = self.length
+    self.position = 0
+    return
@@ -14,21 +14,66 @@
 # more details.
 
 import rsrcdump
+import struct
+
+FORMAT_FORK_HEADER = ">IIII"
+FORMAT_MAP_LISTS = ">HH"
+FORMAT_TYPE_ENTRY = ">4sHH"
+FORMAT_REF_ENTRY = ">hHI"
+TYPE_ENTRY_SIZE = struct.calcsize(FORMAT_TYPE_ENTRY)
+# Each reference is followed by a handle that's only used in memory
+REF_ENTRY_SIZE = struct.calcsize(FORMAT_REF_ENTRY) + 4
+MAP_LISTS_OFFSET = 24
+
+def parseResourceFork(data):
+  # Read only decoding of a resource fork into a dict of (type, ID) to
+  # resource data, for when there's no file for rsrcdump to load
+  dataOffset, mapOffset, _, _ = struct.unpack_from(FORMAT_FORK_HEADER, data)
+  typeListOffset, _ = struct.unpack_from(FORMAT_MAP_LISTS, data, mapOffset + MAP_LISTS_OFFSET)
+  typeList = mapOffset + typeListOffset
+  typeCount = (struct.unpack_from(">H", data, typeList)[0] + 1) & 0xffff
+  resources = {}
+  for idx in range(typeCount):
+    resourceType, count, refListOffset = struct.unpack_from(
+      FORMAT_TYPE_ENTRY, data, typeList + 2 + idx * TYPE_ENTRY_SIZE)
+    resourceType = resourceType.decode("macroman")
+    for ref in range(count + 1):
+      resourceID, _, attrOffset = struct.unpack_from(
+        FORMAT_REF_ENTRY, data, typeList + refListOffset + ref * REF_ENTRY_SIZE)
+      offset = dataOffset + (attrOffset & 0xffffff)
+      length = struct.unpack_from(">I", data, offset)[0]
+      resources[(resourceType, resourceID)] = bytes(data[offset+4:offset+4+length])
+  return resources
 
 class MacResource:
-  def __init__(self, path):
+  def __init__(self, path, data=None):
+    # Given data, the resource fork is only decoded and can't be saved
     self.path = path
-    self.rsrc = rsrcdump.load(self.path)
+    self.rsrc = None
+    self.resources = None
+    self.changed = False
+    if data is not None:
+      self.resources = parseResourceFork(data)
+    else:
+      self.rsrc = rsrcdump.load(self.path)
     return
 
   def dataForResource(self, resourceType, resourceID):
+    if self.resources is not None:
+      return self.resources[(resourceType, resourceID)]
     return self.rsrc[resourceType][resourceID].data
 
   def setDataForResource(self, data, resourceType, resourceID):
+    if self.dataForResource(resourceType, resourceID) == data:
+      return
     self.rsrc[resourceType][resourceID].data = data
+    self.changed = True
     return
 
   def save(self):
+    # Left alone if every resource encoded to the bytes it already had
+    if not self.changed:
+      return
     data = self.rsrc.pack()
     with open(self.path, "wb") as f:
       f.write(data)
@@ -41,8 +41,8 @@ class DNSInfo:
   domain: str
 
 class MacTCP(MacResource):
-  def __init__(self, path):
-    super().__init__(path)
+  def __init__(self, path, data=None):
+    super().__init__(path, data)
     self.ipInfo = self.decodeIPInfo()
     self.dns = self.decodeDNS()
     return
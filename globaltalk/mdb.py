@@ -13,7 +13,7 @@
 # GNU General Public License at <http://www.gnu.org/licenses/> for
 # more details.
 
-from dataclasses import dataclass
+from dataclasses import dataclass, astuple
 import struct
 
 FORMAT_MDB = ">H II HHHHH II H IH B 27s I H III H II 32s H II 3I I 2H2I"
@@ -56,6 +56,8 @@ class MDB:
   catalogExtentsRecord2: int
   catalogExtentsRecord3: int
 
-def loadMDB(data):
-  size = struct.calcsize(FORMAT_MDB)
-  return MDB(*struct.unpack(FORMAT_MDB, data[:size]))
+def loadMDB(data, offset=0):
+  return MDB(*struct.unpack_from(FORMAT_MDB, data, offset))
+
+def encodeMDB(mdb):
+  return struct.pack(FORMAT_MDB, *astuple(mdb))
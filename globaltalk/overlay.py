@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .diskimage import openImage
+from .qcow2 import writeOverlay, DEFAULT_CLUSTER_BITS
+
+import argparse
+import threading
+import struct
+import os
+
+SECTOR_SIZE = 512
+
+DELTA_MAGIC = b"GTDELTA1"
+FORMAT_DELTA_HEADER = ">8sQ"
+STRUCT_DELTA_HEADER = struct.Struct(FORMAT_DELTA_HEADER)
+DELTA_HEADER_SIZE = SECTOR_SIZE
+
+# Each changed sector is stored once as its sector number followed by
+# its contents, records are appended in the order sectors are first
+# written
+FORMAT_DELTA_RECORD = ">Q"
+STRUCT_DELTA_RECORD = struct.Struct(FORMAT_DELTA_RECORD)
+DELTA_RECORD_SIZE = STRUCT_DELTA_RECORD.size + SECTOR_SIZE
+
+class OverlayImage:
+  # Reads come from a base image that is never written, writes go to a
+  # delta file holding only the sectors that changed
+  format = "overlay"
+
+  def __init__(self, basePath, deltaPath, mapped=False):
+    self.base = openImage(basePath, mapped=mapped, writable=False)
+    self.path = deltaPath
+    self.lock = threading.Lock()
+    self.sectors = {}
+
+    if not os.path.exists(deltaPath):
+      with open(deltaPath, "wb") as f:
+        header = STRUCT_DELTA_HEADER.pack(DELTA_MAGIC, self.base.size)
+        f.write(header + bytes(DELTA_HEADER_SIZE - len(header)))
+    self.stream = open(deltaPath, "r+b")
+    self.fd = self.stream.fileno()
+
+    magic, baseSize = STRUCT_DELTA_HEADER.unpack(os.pread(self.fd, STRUCT_DELTA_HEADER.size, 0))
+    if magic != DELTA_MAGIC:
+      raise ValueError("Not an overlay delta file", deltaPath)
+    if baseSize != self.base.size:
+      raise ValueError("Overlay delta was made for a different base image", deltaPath)
+
+    # A record cut short by a crash is dropped
+    length = os.fstat(self.fd).st_size - DELTA_HEADER_SIZE
+    self.end = DELTA_HEADER_SIZE + length // DELTA_RECORD_SIZE * DELTA_RECORD_SIZE
+    for offset in range(DELTA_HEADER_SIZE, self.end, DELTA_RECORD_SIZE):
+      sector = STRUCT_DELTA_RECORD.unpack(os.pread(self.fd, STRUCT_DELTA_RECORD.size, offset))[0]
+      self.sectors[sector] = offset + STRUCT_DELTA_RECORD.size
+    return
+
+  @property
+  def mapped(self):
+    return self.base.mapped
+
+  @property
+  def size(self):
+    return self.base.size
+
+  def readDelta(self, sector):
+    return os.pread(self.fd, SECTOR_SIZE, self.sectors[sector])
+
+  def read(self, offset, length):
+    data = self.base.read(offset, length)
+    if not self.sectors or not length:
+      return data
+
+    first = offset // SECTOR_SIZE
+    last = (offset + length - 1) // SECTOR_SIZE
+    if len(self.sectors) < last - first + 1:
+      changed = [x for x in self.sectors if first <= x <= last]
+    else:
+      changed = [x for x in range(first, last + 1) if x in self.sectors]
+    if not changed:
+      return data
+
+    data = bytearray(data)
+    for sector in changed:
+      start = sector * SECTOR_SIZE
+      lo = max(start, offset)
+      hi = min(start + SECTOR_SIZE, offset + length)
+      data[lo-offset:hi-offset] = self.readDelta(sector)[lo-start:hi-start]
+    return bytes(data)
+
+  def write(self, offset, data):
+    end = offset + len(data)
+    with self.lock:
+      for sector in range(offset // SECTOR_SIZE, (end - 1) // SECTOR_SIZE + 1):
+        start = sector * SECTOR_SIZE
+        lo = max(start, offset)
+        hi = min(start + SECTOR_SIZE, end)
+        if hi - lo == SECTOR_SIZE:
+          buf = data[lo-offset:hi-offset]
+        else:
+          buf = bytearray(self.read(start, SECTOR_SIZE))
+          buf[lo-start:hi-start] = data[lo-offset:hi-offset]
+
+        pointer = self.sectors.get(sector)
+        if pointer is not None:
+          os.pwrite(self.fd, buf, pointer)
+        else:
+          os.pwrite(self.fd, STRUCT_DELTA_RECORD.pack(sector) + bytes(buf), self.end)
+          self.sectors[sector] = self.end + STRUCT_DELTA_RECORD.size
+          self.end += DELTA_RECORD_SIZE
+    return len(data)
+
+  def flush(self):
+    os.fsync(self.fd)
+    return
+
+  def commit(self):
+    # Writes every changed sector into the base image and empties the delta
+    with self.lock:
+      base = openImage(self.base.path)
+      for sector in sorted(self.sectors):
+        base.write(sector * SECTOR_SIZE, self.readDelta(sector))
+      base.flush()
+      base.close()
+      self.sectors.clear()
+      self.end = DELTA_HEADER_SIZE
+      os.ftruncate(self.fd, self.end)
+      os.fsync(self.fd)
+    return
+
+  def exportQcow2(self, path, clusterBits=DEFAULT_CLUSTER_BITS):
+    # QEMU can boot the result directly with the base image as its
+    # backing file. Clusters with any changed sector are copied whole.
+    clusterSize = 1 << clusterBits
+    perCluster = clusterSize // SECTOR_SIZE
+    clusters = {}
+    for index in sorted(set(x // perCluster for x in self.sectors)):
+      clusters[index] = self.read(index * clusterSize, clusterSize)
+    writeOverlay(path, self.size, clusters, os.path.abspath(self.base.path),
+                 self.base.format, clusterBits)
+    return
+
+  def close(self):
+    self.stream.close()
+    self.base.close()
+    return
+
+def build_argparser():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("base", help="raw or qcow2 base image")
+  parser.add_argument("delta", help="overlay delta file")
+  parser.add_argument("--commit", action="store_true",
+                      help="write the changes into the base image and empty the delta")
+  parser.add_argument("--qcow2", help="export the changes as a qcow2 overlay of the base")
+  return parser
+
+def main():
+  args = build_argparser().parse_args()
+
+  image = OverlayImage(args.base, args.delta)
+  print(f"{args.delta}: {len(image.sectors)} changed sectors")
+  if args.qcow2:
+    image.exportQcow2(args.qcow2)
+  if args.commit:
+    image.commit()
+  image.close()
+  return
+
+if __name__ == '__main__':
+  exit(main() or 0)
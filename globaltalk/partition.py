@@ -39,6 +39,5 @@ class Partition:
   bootChecksum: int
   processor: bytes
 
-def loadPartition(data):
-  size = struct.calcsize(FORMAT_PARTITION)
-  return Partition(*struct.unpack(FORMAT_PARTITION, data[:size]))
+def loadPartition(data, offset=0):
+  return Partition(*struct.unpack_from(FORMAT_PARTITION, data, offset))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .clone import clone
+from .routerconfig import RouterConfig, applyConfig
+from .macdisk import HFSDisk
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import time
+import os
+
+# A manifest looks like:
+#
+# {
+#   "image": "golden/globaltalk.img",
+#   "defaults": {"gateway": "10.0.0.1", "dns_server": ["10.0.0.53"]},
+#   "instances": [
+#     {"name": "router1", "ip_address": "10.0.0.11/24",
+#      "appletalk_zone": "Zone 1", "appletalk_number": 101,
+#      "appletalk_hosts": ["10.0.0.12", "10.0.0.13"]},
+#     ...
+#   ]
+# }
+#
+# Instance settings use the start-globaltalk option names and override
+# the defaults. Each instance gets its own directory under the output
+# directory holding its image, pram.img and Q800.ROM.
+
+def loadManifest(path):
+  with open(path) as f:
+    manifest = json.load(f)
+  base = os.path.dirname(os.path.abspath(path))
+  image = os.path.join(base, manifest["image"])
+  defaults = manifest.get("defaults", {})
+  instances = []
+  names = set()
+  for entry in manifest["instances"]:
+    name = entry["name"]
+    if not name or os.sep in name or name in names:
+      raise ValueError("Instance names must be unique file names", name)
+    names.add(name)
+    instances.append((name, {**defaults, **entry}))
+  return image, instances
+
+def provisionInstance(name, image, path, values, force=False):
+  # Runs in a worker process, so everything comes back in the report
+  # rather than as an exception
+  report = {"name": name, "image": path, "status": "ok", "cloned": None,
+            "problems": [], "seconds": 0}
+  start = time.monotonic()
+  try:
+    config = RouterConfig.fromDict(values)
+    config.validate()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if force and os.path.exists(path):
+      os.unlink(path)
+    report["cloned"] = "reflinked" if clone(image, path) else "copied"
+
+    disk = HFSDisk(path, mapped=True, indexCache=True)
+    try:
+      applyConfig(disk, config)
+      report["problems"] = disk.catalog.verify()
+    finally:
+      disk.close()
+    if report["problems"]:
+      report["status"] = "damaged"
+  except Exception as e:
+    report["status"] = "failed"
+    report["problems"] = [f"{type(e).__name__}: {e}"]
+  report["seconds"] = round(time.monotonic() - start, 3)
+  return report
+
+def provision(image, instances, outputDir, jobs=None, force=False):
+  # Yields a report for each instance as it finishes
+  with ProcessPoolExecutor(max_workers=jobs) as pool:
+    futures = []
+    for name, values in instances:
+      path = os.path.join(outputDir, name, os.path.basename(image))
+      futures.append(pool.submit(provisionInstance, name, image, path, values, force))
+    for future in futures:
+      yield future.result()
+  return
+
+def build_argparser():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("manifest", help="JSON manifest of router instances")
+  parser.add_argument("output", help="directory to create the instances in")
+  parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                      help="instances to provision at once")
+  parser.add_argument("--force", action="store_true", help="replace existing instance images")
+  parser.add_argument("--report", help="also write the report as JSON to this file")
+  return parser
+
+def main():
+  args = build_argparser().parse_args()
+
+  image, instances = loadManifest(args.manifest)
+  reports = []
+  for report in provision(image, instances, args.output, args.jobs, args.force):
+    reports.append(report)
+    print(f"{report['name']}: {report['status']}, {report['cloned'] or 'not cloned'},"
+          f" {report['seconds']}s")
+    for problem in report["problems"]:
+      print(f"  {problem}")
+
+  if args.report:
+    with open(args.report, "w") as f:
+      json.dump(reports, f, indent=2)
+  return int(any(x["status"] != "ok" for x in reports))
+
+if __name__ == '__main__':
+  exit(main() or 0)
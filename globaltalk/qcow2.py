@@ -0,0 +1,423 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .diskimage import openImage, punchHole
+
+from collections import OrderedDict
+import threading
+import struct
+import zlib
+import os
+
+QCOW2_MAGIC = b"QFI\xfb"
+QCOW2_VERSION = 3
+DEFAULT_CLUSTER_BITS = 16
+REFCOUNT_ORDER = 4
+L2_CACHE_SIZE = 32
+
+# Version 2 headers stop after the snapshot offset, version 3 adds the
+# feature bits, refcount width and header length
+FORMAT_HEADER_V2 = ">4sI QI I Q I I Q Q I I Q"
+FORMAT_HEADER = FORMAT_HEADER_V2 + " QQQ II"
+STRUCT_HEADER_V2 = struct.Struct(FORMAT_HEADER_V2)
+STRUCT_HEADER = struct.Struct(FORMAT_HEADER)
+
+HEADER_REFCOUNT_TABLE = 48
+HEADER_AUTOCLEAR = 88
+
+EXT_END = 0
+EXT_BACKING_FORMAT = 0xE2792ACA
+
+INCOMPAT_DIRTY = 1 << 0
+INCOMPAT_CORRUPT = 1 << 1
+
+# Set on L1 and L2 entries whose cluster has a refcount of exactly one
+OFLAG_COPIED = 1 << 63
+OFLAG_COMPRESSED = 1 << 62
+OFLAG_ZERO = 1 << 0
+OFFSET_MASK = 0x00fffffffffffe00
+
+class Qcow2Error(Exception):
+  pass
+
+def divideUp(value, divisor):
+  return (value + divisor - 1) // divisor
+
+def packHeaderCluster(clusterBits, size, l1Size, l1Offset, refcountOffset,
+                      refcountClusters, backingFile=None, backingFormat=None):
+  extensions = b""
+  if backingFormat:
+    name = backingFormat.encode()
+    extensions += struct.pack(">II", EXT_BACKING_FORMAT, len(name))
+    extensions += name + bytes(-len(name) % 8)
+  extensions += struct.pack(">II", EXT_END, 0)
+
+  backing = backingFile.encode() if backingFile else b""
+  backingOffset = STRUCT_HEADER.size + len(extensions) if backing else 0
+  header = STRUCT_HEADER.pack(QCOW2_MAGIC, QCOW2_VERSION, backingOffset, len(backing),
+                              clusterBits, size, 0, l1Size, l1Offset,
+                              refcountOffset, refcountClusters, 0, 0,
+                              0, 0, 0, REFCOUNT_ORDER, STRUCT_HEADER.size)
+  data = header + extensions + backing
+  clusterSize = 1 << clusterBits
+  if len(data) > clusterSize:
+    raise ValueError("Backing file name too long")
+  return data + bytes(clusterSize - len(data))
+
+def writeOverlay(path, size, clusters, backingFile=None, backingFormat=None,
+                 clusterBits=DEFAULT_CLUSTER_BITS):
+  # Writes a new qcow2 image holding only the given guest clusters, a
+  # dict of cluster index to cluster data. Everything else reads
+  # through to backingFile.
+  clusterSize = 1 << clusterBits
+  l2Entries = clusterSize // 8
+  l1Size = max(1, divideUp(size, clusterSize * l2Entries))
+  l1Clusters = divideUp(l1Size * 8, clusterSize)
+  tables = sorted(set(x // l2Entries for x in clusters))
+  guest = sorted(clusters)
+
+  # Header, refcount table, L1, L2 tables, data, then refcount blocks
+  # sized to cover everything including themselves
+  refcountOffset = clusterSize
+  l1Offset = 2 * clusterSize
+  nextCluster = 2 + l1Clusters
+  l2Offsets = {}
+  for table in tables:
+    l2Offsets[table] = nextCluster * clusterSize
+    nextCluster += 1
+  dataOffsets = {}
+  for index in guest:
+    dataOffsets[index] = nextCluster * clusterSize
+    nextCluster += 1
+  perBlock = clusterSize * 8 // (1 << REFCOUNT_ORDER)
+  blocks = 1
+  while divideUp(nextCluster + blocks, perBlock) > blocks:
+    blocks += 1
+  if blocks > clusterSize // 8:
+    raise ValueError("Image too large for a single refcount table cluster")
+  total = nextCluster + blocks
+
+  with open(path, "wb") as f:
+    f.write(packHeaderCluster(clusterBits, size, l1Size, l1Offset, refcountOffset, 1,
+                              backingFile, backingFormat))
+
+    refcountTable = bytearray(clusterSize)
+    for block in range(blocks):
+      struct.pack_into(">Q", refcountTable, block * 8, (nextCluster + block) * clusterSize)
+    f.write(refcountTable)
+
+    l1 = bytearray(l1Clusters * clusterSize)
+    for table, offset in l2Offsets.items():
+      struct.pack_into(">Q", l1, table * 8, offset | OFLAG_COPIED)
+    f.write(l1)
+
+    for table in tables:
+      l2 = bytearray(clusterSize)
+      for index in guest:
+        if index // l2Entries == table:
+          struct.pack_into(">Q", l2, (index % l2Entries) * 8, dataOffsets[index] | OFLAG_COPIED)
+      f.write(l2)
+
+    for index in guest:
+      data = bytes(clusters[index])
+      f.write(data + bytes(clusterSize - len(data)))
+
+    refcounts = bytearray(blocks * clusterSize)
+    struct.pack_into(f">{total}H", refcounts, 0, *([1] * total))
+    f.write(refcounts)
+  return
+
+class Qcow2Image:
+  # Byte addressed access to a qcow2 image, with the same interface as
+  # RawImage. New clusters are always appended to the end of the file
+  # and clusters that are no longer used are not reused.
+  format = "qcow2"
+  mapped = False
+
+  def __init__(self, path, writable=True, l2CacheSize=L2_CACHE_SIZE):
+    self.path = path
+    self.writable = writable
+    self.stream = open(self.path, "r+b" if writable else "rb")
+    self.fd = self.stream.fileno()
+    self.lock = threading.RLock()
+    self.l2Cache = OrderedDict()
+    self.l2CacheSize = l2CacheSize
+
+    data = os.pread(self.fd, STRUCT_HEADER.size, 0)
+    if data[:4] != QCOW2_MAGIC:
+      raise Qcow2Error("Not a qcow2 image", path)
+    version = struct.unpack_from(">I", data, 4)[0]
+    if version == 2:
+      fields = STRUCT_HEADER_V2.unpack_from(data) + (0, 0, 0, REFCOUNT_ORDER,
+                                                     STRUCT_HEADER_V2.size)
+    elif version == 3:
+      fields = STRUCT_HEADER.unpack_from(data)
+    else:
+      raise Qcow2Error("Unsupported qcow2 version", version)
+    (_, self.version, backingOffset, backingSize, self.clusterBits, self.size,
+     cryptMethod, l1Size, self.l1Offset, self.refcountOffset, refcountClusters,
+     snapshots, _, incompatible, _, self.autoclear, refcountOrder,
+     headerLength) = fields
+
+    if cryptMethod:
+      raise Qcow2Error("Encrypted qcow2 images aren't supported", path)
+    if incompatible & ~(INCOMPAT_DIRTY | INCOMPAT_CORRUPT):
+      raise Qcow2Error("Unsupported qcow2 features", incompatible)
+    if writable and (incompatible or snapshots or refcountOrder != REFCOUNT_ORDER):
+      raise Qcow2Error("qcow2 image can only be opened read only", path)
+
+    self.clusterSize = 1 << self.clusterBits
+    self.l2Entries = self.clusterSize // 8
+    self.refcountsPerBlock = self.clusterSize * 8 >> refcountOrder
+    self.l1 = list(struct.unpack(f">{l1Size}Q", os.pread(self.fd, l1Size * 8, self.l1Offset)))
+    count = refcountClusters * self.clusterSize // 8
+    self.refcountTable = list(struct.unpack(f">{count}Q",
+                                            os.pread(self.fd, count * 8, self.refcountOffset)))
+    size = os.fstat(self.fd).st_size
+    self.end = (size + self.clusterSize - 1) // self.clusterSize * self.clusterSize
+
+    self.backing = None
+    if backingOffset:
+      name = os.pread(self.fd, backingSize, backingOffset).decode()
+      backingPath = os.path.join(os.path.dirname(os.path.abspath(path)), name)
+      self.backing = openImage(backingPath, writable=False)
+    return
+
+  @classmethod
+  def create(cls, path, size, backingFile=None, backingFormat=None,
+             clusterBits=DEFAULT_CLUSTER_BITS):
+    writeOverlay(path, size, {}, backingFile, backingFormat, clusterBits)
+    return cls(path)
+
+  def l2Table(self, l2Offset):
+    table = self.l2Cache.get(l2Offset)
+    if table is not None:
+      self.l2Cache.move_to_end(l2Offset)
+      return table
+    table = list(struct.unpack(f">{self.l2Entries}Q",
+                               os.pread(self.fd, self.clusterSize, l2Offset)))
+    self.l2Cache[l2Offset] = table
+    if len(self.l2Cache) > self.l2CacheSize:
+      self.l2Cache.popitem(last=False)
+    return table
+
+  def l2Entry(self, cluster):
+    l1Index, l2Index = divmod(cluster, self.l2Entries)
+    if l1Index >= len(self.l1):
+      return 0
+    l2Offset = self.l1[l1Index] & OFFSET_MASK
+    if not l2Offset:
+      return 0
+    return self.l2Table(l2Offset)[l2Index]
+
+  def compressedRange(self, entry):
+    # Compressed cluster descriptors pack the host offset and the number
+    # of extra 512 byte sectors the compressed data covers
+    offsetBits = 62 - (self.clusterBits - 8)
+    offset = entry & ((1 << offsetBits) - 1)
+    sectors = ((entry >> offsetBits) & ((1 << (self.clusterBits - 8)) - 1)) + 1
+    return offset, sectors * 512 - (offset & 511)
+
+  def readCompressed(self, entry):
+    offset, length = self.compressedRange(entry)
+    return zlib.decompressobj(-15).decompress(os.pread(self.fd, length, offset),
+                                              self.clusterSize)
+
+  def readCluster(self, cluster, within, count):
+    entry = self.l2Entry(cluster)
+    if entry & OFLAG_COMPRESSED:
+      return self.readCompressed(entry)[within:within+count]
+    if entry & OFFSET_MASK:
+      return os.pread(self.fd, count, (entry & OFFSET_MASK) + within)
+    if entry & OFLAG_ZERO or self.backing is None:
+      return bytes(count)
+    data = self.backing.read(cluster * self.clusterSize + within, count)
+    return bytes(data) + bytes(count - len(data))
+
+  def read(self, offset, length):
+    length = max(0, min(length, self.size - offset))
+    pieces = []
+    position = offset
+    with self.lock:
+      while position < offset + length:
+        cluster, within = divmod(position, self.clusterSize)
+        count = min(self.clusterSize - within, offset + length - position)
+        pieces.append(self.readCluster(cluster, within, count))
+        position += count
+    return b"".join(pieces)
+
+  def write(self, offset, data):
+    if not self.writable:
+      raise Qcow2Error("qcow2 image is read only", self.path)
+    data = memoryview(data)
+    if offset + len(data) > self.size:
+      raise ValueError("Write past end of image", offset + len(data))
+    with self.lock:
+      if self.autoclear:
+        # Features we don't know about have to be dropped once we write
+        self.autoclear = 0
+        if self.version > 2:
+          os.pwrite(self.fd, struct.pack(">Q", 0), HEADER_AUTOCLEAR)
+      done = 0
+      while done < len(data):
+        cluster, within = divmod(offset + done, self.clusterSize)
+        count = min(self.clusterSize - within, len(data) - done)
+        self.writeCluster(cluster, within, data[done:done+count])
+        done += count
+    return len(data)
+
+  def writeCluster(self, cluster, within, data):
+    entry = self.l2Entry(cluster)
+    if entry & OFLAG_COPIED and not entry & OFLAG_COMPRESSED and entry & OFFSET_MASK:
+      os.pwrite(self.fd, data, (entry & OFFSET_MASK) + within)
+      return
+
+    # Copy on write: the new cluster starts out as whatever the guest
+    # saw there before, from a shared, compressed or backing cluster
+    if len(data) == self.clusterSize:
+      buf = bytes(data)
+    else:
+      buf = bytearray(self.readCluster(cluster, 0, self.clusterSize))
+      buf[within:within+len(data)] = data
+    host = self.allocateCluster()
+    os.pwrite(self.fd, buf, host)
+    self.setL2Entry(cluster, host | OFLAG_COPIED)
+    self.releaseEntry(entry)
+    return
+
+  def releaseEntry(self, entry):
+    # Drops the reference an L2 entry held. Host clusters nothing uses
+    # any more are punched out of the file.
+    if entry & OFLAG_COMPRESSED:
+      offset, length = self.compressedRange(entry)
+      hostClusters = range(offset // self.clusterSize,
+                           (offset + length - 1) // self.clusterSize + 1)
+    elif entry & OFFSET_MASK:
+      hostClusters = [(entry & OFFSET_MASK) // self.clusterSize]
+    else:
+      return
+    for hostCluster in hostClusters:
+      if not self.addRefcount(hostCluster, -1):
+        punchHole(self.fd, hostCluster * self.clusterSize, self.clusterSize)
+    return
+
+  def allocated(self, offset, length):
+    total = 0
+    position = offset
+    end = min(offset + length, self.size)
+    with self.lock:
+      while position < end:
+        cluster, within = divmod(position, self.clusterSize)
+        count = min(self.clusterSize - within, end - position)
+        if self.l2Entry(cluster) & (OFFSET_MASK | OFLAG_COMPRESSED):
+          total += count
+        position += count
+    return total
+
+  def discard(self, offset, length):
+    # Whole clusters are unmapped, or marked as zero if a backing file
+    # would otherwise show through. Partial clusters are zeroed in place.
+    if not self.writable:
+      raise Qcow2Error("qcow2 image is read only", self.path)
+    position = offset
+    end = min(offset + length, self.size)
+    with self.lock:
+      while position < end:
+        cluster, within = divmod(position, self.clusterSize)
+        count = min(self.clusterSize - within, end - position)
+        position += count
+        entry = self.l2Entry(cluster)
+        if not entry & (OFFSET_MASK | OFLAG_COMPRESSED):
+          continue
+        if count == self.clusterSize:
+          if self.backing is None:
+            self.setL2Entry(cluster, 0)
+          elif self.version > 2:
+            self.setL2Entry(cluster, OFLAG_ZERO)
+          else:
+            self.writeCluster(cluster, 0, bytes(count))
+            continue
+          self.releaseEntry(entry)
+        elif entry & OFLAG_COPIED and not entry & OFLAG_COMPRESSED:
+          host = (entry & OFFSET_MASK) + within
+          if not punchHole(self.fd, host, count):
+            os.pwrite(self.fd, bytes(count), host)
+    return
+
+  def setL2Entry(self, cluster, value):
+    l1Index, l2Index = divmod(cluster, self.l2Entries)
+    l2Offset = self.l1[l1Index] & OFFSET_MASK
+    if not l2Offset:
+      l2Offset = self.allocateCluster()
+      os.pwrite(self.fd, bytes(self.clusterSize), l2Offset)
+      self.l1[l1Index] = l2Offset | OFLAG_COPIED
+      os.pwrite(self.fd, struct.pack(">Q", self.l1[l1Index]), self.l1Offset + l1Index * 8)
+    self.l2Table(l2Offset)[l2Index] = value
+    os.pwrite(self.fd, struct.pack(">Q", value), l2Offset + l2Index * 8)
+    return
+
+  def allocateCluster(self):
+    offset = self.end
+    self.end += self.clusterSize
+    os.ftruncate(self.fd, self.end)
+    self.addRefcount(offset // self.clusterSize, 1)
+    return offset
+
+  def addRefcount(self, cluster, delta):
+    blockIndex, index = divmod(cluster, self.refcountsPerBlock)
+    if blockIndex >= len(self.refcountTable):
+      self.growRefcountTable(blockIndex + 1)
+    blockOffset = self.refcountTable[blockIndex] & OFFSET_MASK
+    if not blockOffset:
+      # A new refcount block counts itself, possibly in its own entries
+      blockOffset = self.end
+      self.end += self.clusterSize
+      os.pwrite(self.fd, bytes(self.clusterSize), blockOffset)
+      self.refcountTable[blockIndex] = blockOffset
+      os.pwrite(self.fd, struct.pack(">Q", blockOffset), self.refcountOffset + blockIndex * 8)
+      self.addRefcount(blockOffset // self.clusterSize, 1)
+    pointer = blockOffset + index * 2
+    count = struct.unpack(">H", os.pread(self.fd, 2, pointer))[0] + delta
+    os.pwrite(self.fd, struct.pack(">H", count), pointer)
+    return count
+
+  def growRefcountTable(self, entries):
+    oldOffset = self.refcountOffset
+    oldClusters = len(self.refcountTable) * 8 // self.clusterSize
+    clusters = max(oldClusters * 2, (entries * 8 + self.clusterSize - 1) // self.clusterSize)
+    self.refcountTable += [0] * (clusters * self.clusterSize // 8 - len(self.refcountTable))
+
+    offset = self.end
+    self.end += clusters * self.clusterSize
+    os.pwrite(self.fd, struct.pack(f">{len(self.refcountTable)}Q", *self.refcountTable), offset)
+    os.fsync(self.fd)
+    os.pwrite(self.fd, struct.pack(">QI", offset, clusters), HEADER_REFCOUNT_TABLE)
+    self.refcountOffset = offset
+    for cluster in range(clusters):
+      self.addRefcount(offset // self.clusterSize + cluster, 1)
+    for cluster in range(oldClusters):
+      self.addRefcount(oldOffset // self.clusterSize + cluster, -1)
+    return
+
+  def flush(self):
+    if self.writable:
+      os.fsync(self.fd)
+    return
+
+  def close(self):
+    if self.backing is not None:
+      self.backing.close()
+    self.stream.close()
+    return
@@ -0,0 +1,180 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .macfile import MacFile
+from .mactcp import MacTCP
+from .airconfig import AIRConfig
+from .airprefs import AIRPrefs
+
+from dataclasses import dataclass, field, asdict, astuple
+import hashlib
+import json
+import re
+import os
+
+GLOBALTALK_CONFIG = "GlobalTalk-config"
+SHARE_PREFIX = "/usr/local/share"
+MACTCP_PATH = ":System Folder:Preferences:MacTCP Prep"
+ROUTER_PATH = ":System Folder:Extensions:Router"
+
+IP_PATTERN = "[0-9]+[.][0-9]+[.][0-9]+[.][0-9]+"
+
+FINGERPRINT_SUFFIX = ".gtcfg"
+
+@dataclass
+class RouterConfig:
+  ipAddress: str = None
+  gateway: str = None
+  dnsServers: list = field(default_factory=list)
+  zone: str = None
+  network: int = None
+  hosts: list = field(default_factory=list)
+
+  @classmethod
+  def fromDict(cls, values):
+    # Takes the same names as the start-globaltalk options
+    dns = values.get("dns_server") or []
+    if isinstance(dns, str):
+      dns = [dns]
+    hosts = values.get("appletalk_hosts") or []
+    if isinstance(hosts, str):
+      hosts = hosts.split(",")
+    return cls(values.get("ip_address"), values.get("gateway"), list(dns),
+               values.get("appletalk_zone"), values.get("appletalk_number"), list(hosts))
+
+  @property
+  def configuresTCP(self):
+    return bool(self.ipAddress or self.dnsServers)
+
+  @property
+  def configuresRouter(self):
+    return bool(self.zone or self.network or self.hosts)
+
+  def dnsEntries(self):
+    # Servers are given as address or address:domain
+    entries = []
+    for dns in self.dnsServers:
+      values = dns.split(":")
+      if not re.match(f"^{IP_PATTERN}$", values[0]):
+        raise ValueError(f"Invalid IP address: {values[0]}")
+      entries.append((values[0], values[1] if len(values) > 1 else "."))
+    return entries
+
+  def validate(self):
+    if self.ipAddress and not re.match(f"^{IP_PATTERN}/[0-9]+$", self.ipAddress):
+      raise ValueError(f"Invalid IP or netmask specified: {self.ipAddress}")
+    self.dnsEntries()
+    if self.configuresRouter:
+      if not self.zone:
+        raise ValueError("Must provide appletalk_zone")
+      if self.network is None:
+        raise ValueError("Must provide appletalk_number")
+      if not self.hosts:
+        raise ValueError("Must provide appletalk_hosts")
+    return
+
+def configTemplate(hdPath):
+  # A GlobalTalk-config next to the image wins over the installed one
+  path = os.path.join(os.path.dirname(os.path.abspath(hdPath)), f"{GLOBALTALK_CONFIG}.bin")
+  if not os.path.exists(path):
+    path = os.path.join(SHARE_PREFIX, f"{GLOBALTALK_CONFIG}.bin")
+  return path
+
+def configFingerprint(disk, config):
+  # Covers the settings, the template they're applied to and the
+  # catalog records of the files they end up in, so anything else
+  # changing those files, like the Mac itself, forces a new apply
+  digest = hashlib.sha256(json.dumps(asdict(config), sort_keys=True).encode())
+  if config.configuresRouter:
+    with open(configTemplate(disk.path), "rb") as f:
+      digest.update(f.read())
+  for macPath in (MACTCP_PATH, f":{GLOBALTALK_CONFIG}", ROUTER_PATH):
+    found = disk.catalog.findPath(macPath)
+    record = astuple(found[3].data) if found is not None else None
+    digest.update(repr(record).encode())
+  return digest.hexdigest()
+
+def loadFingerprint(path):
+  try:
+    with open(path) as f:
+      return f.read().strip()
+  except OSError:
+    return None
+
+def saveFingerprint(fingerprint, path):
+  temp = path + ".tmp"
+  try:
+    with open(temp, "w") as f:
+      print(fingerprint, file=f)
+    os.replace(temp, path)
+  except OSError:
+    # Only saves work on the next start, a read-only directory is fine
+    return False
+  return True
+
+def applyConfig(disk, config, fingerprintPath=None):
+  # Writes config into MacTCP and the Apple Internet Router files on
+  # disk. Nothing is written if config isn't valid, and files that
+  # already hold the new settings are left alone. With fingerprintPath
+  # the whole apply is skipped when it was the last one done. Returns
+  # True if anything was written.
+  config.validate()
+  if fingerprintPath is not None \
+     and loadFingerprint(fingerprintPath) == configFingerprint(disk, config):
+    return False
+
+  written = False
+  with disk.transaction():
+    if config.configuresTCP:
+      mtcp_prefs = MacFile(disk.path, MACTCP_PATH, disk=disk)
+      mtcp = MacTCP(mtcp_prefs.resourcePath)
+
+      if config.ipAddress:
+        mtcp.setIPAddress(config.ipAddress, gateway=config.gateway)
+
+      if config.dnsServers:
+        mtcp.dns = []
+        for ip_address, domain in config.dnsEntries():
+          mtcp.addDNS(ip_address, domain)
+
+      mtcp.save()
+      written |= mtcp_prefs.save()
+
+    if config.configuresRouter:
+      gt_conf = MacFile(disk.path, f":{GLOBALTALK_CONFIG}", dataPath=configTemplate(disk.path),
+                        disk=disk)
+      airconf = AIRConfig(gt_conf.resourcePath)
+      airconf.setRouterName(config.zone)
+      airconf.setZoneName(config.zone)
+      airconf.setZoneNumber(config.network, config.network)
+      airconf.setHosts(config.hosts)
+
+      airconf.save()
+      written |= gt_conf.save()
+      gt_cnid = gt_conf.catalogID
+
+      pref_file = MacFile(disk.path, ROUTER_PATH, disk=disk)
+      airprefs = AIRPrefs(pref_file.resourcePath)
+      airprefs.setFilename(GLOBALTALK_CONFIG)
+      airprefs.setCNID(gt_cnid)
+      airprefs.setAutostart(True)
+      airprefs.save()
+      written |= pref_file.save()
+
+      written |= disk.catalog.createFileThread(gt_cnid)
+
+  if fingerprintPath is not None:
+    saveFingerprint(configFingerprint(disk, config), fingerprintPath)
+  return written
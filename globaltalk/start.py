@@ -15,19 +15,17 @@
 # GNU General Public License at <http://www.gnu.org/licenses/> for
 # more details.
 
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import os
 import subprocess
-import json
-import re
-import struct
 
 from globaltalk import *
+from globaltalk.routerconfig import RouterConfig, applyConfig, FINGERPRINT_SUFFIX
+from globaltalk.imageformat import imageInfo
 
 QEMU_CONF_PREFIX = "/usr/local/etc/qemu"
-GLOBALTALK_CONFIG = "GlobalTalk-config"
-
-IP_PATTERN = "[0-9]+[.][0-9]+[.][0-9]+[.][0-9]+"
+STARTUP_WORKERS = 5
 
 def build_argparser():
   parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -48,50 +46,46 @@ def build_argparser():
   parser.add_argument("--vnc_port", default="::1:10", help="VNC port")
   parser.add_argument("--resolution", default="1152x870x8", help="Graphics resolution")
   parser.add_argument("--reset_pram", action="store_true", help="reset pram.img")
+  parser.add_argument("--overlay",
+                      help="leave hd_image untouched, keep changes in this delta file"
+                      " and boot from a qcow2 overlay made from it")
   return parser
 
 def image_info(path):
-  cmd = ["qemu-img", "info", "--output=json", path]
-  process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-  pstr = process.stdout.read()
-  process.stdout.close()
-  if isinstance(pstr, bytes):
-    pstr = str(pstr, "utf-8")
-  return json.loads(pstr)
-
-def create_thread_record(disk_path, cnid, filename):
-  disk = HFSDisk(disk_path)
-  disk.mount()
-
-  # FIXME - make sure it's unique
-  thread_path = f":{filename}2"
-  cmd = ["hmkdir", thread_path]
-  subprocess.run(cmd)
-  disk.unmount()
-
-  thread_file = MacFile(disk_path, thread_path)
-  catalog = Catalog(disk)
-  node = catalog.findNode((thread_file.catalogID, ""))
-  sectorNum = catalog.sectorForNode(node[0])
-  sector = bytearray(disk.readSector(sectorNum))
-  pointer = (node[2] + 1) * -2
-  offset = struct.unpack(">H", sector[pointer:pointer+2])[0]
-  reclen = sector[offset]
-
-  sector[offset+2:offset+6] = struct.pack(">I", cnid)
-  pointer = offset+reclen+1
-  pointer = (pointer + 1) // 2 * 2
-  sector[pointer] = 0x04
-  sector[pointer+14] -= 1
-  sector[pointer+15+sector[pointer+14]] = 0
-  disk.writeSector(sectorNum, sector)
-  disk.stream.close()
-
-  disk.mount()
-  cmd = ["hrmdir", thread_path]
-  subprocess.run(cmd)
-  disk.unmount()
+  return imageInfo(path)
+
+def preflight_network(bridge):
+  cmd = ["iptables", "-C", "FORWARD", "-p", "all", "-i", bridge, "-j", "ACCEPT"]
+  status = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  if status.returncode:
+    cmd[1] = "-A"
+    status = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+  with open(os.path.join(QEMU_CONF_PREFIX, "bridge.conf"), "w") as f:
+    print(f"allow {bridge}", file=f)
+  return
+
+def create_pram(pram_path, reset=False):
+  if not os.path.exists(pram_path) or reset:
+    pram = bytearray([0] * 256)
+    with open(pram_path, mode="wb") as f:
+      f.write(pram)
+  return
 
+def configure_disk(args, config):
+  disk = HFSDisk(args.hd_image, mapped=True, indexCache=True, delta=args.overlay)
+  try:
+    # A restart with the same settings goes straight on to QEMU
+    if (config.configuresTCP or config.configuresRouter) \
+       and applyConfig(disk, config, (args.overlay or args.hd_image) + FINGERPRINT_SUFFIX):
+      # Catch a damaged catalog here rather than when the Mac fails to boot
+      for problem in disk.catalog.verify():
+        print("Catalog problem:", problem)
+    if args.overlay:
+      # Rebuilt every start, so the Mac's own writes to the last one are dropped
+      disk.exportOverlay(f"{args.overlay}.qcow2")
+  finally:
+    disk.close()
   return
 
 def main():
@@ -107,112 +101,67 @@ def main():
     print(f"Interface {args.bridge} does not exist")
     exit(1)
 
-  if args.ip_address and not re.match(f"^{IP_PATTERN}/[0-9]+$", args.ip_address):
-    print("Invalid IP or netmask specified:", args.ip_address)
+  config = RouterConfig.fromDict(vars(args))
+  try:
+    config.validate()
+  except ValueError as e:
+    print(e)
     exit(1)
 
-  cmd = ["iptables", "-C", "FORWARD", "-p", "all", "-i", args.bridge, "-j", "ACCEPT"]
-  status = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-  if status.returncode:
-    cmd[1] = "-A"
-    status = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-  with open(os.path.join(QEMU_CONF_PREFIX, "bridge.conf"), "w") as f:
-    print(f"allow {args.bridge}", file=f)
+  if args.overlay and image_info(args.hd_image)['format'] not in ("raw", "qcow2"):
+    print("Overlays need a raw or qcow2 hd_image")
+    exit(1)
 
   hd_path = os.path.dirname(os.path.abspath(args.hd_image))
   pram_path = os.path.join(hd_path, "pram.img")
 
-  if not os.path.exists(pram_path) or args.reset_pram:
-    pram = bytearray([0] * 256)
-    with open(pram_path, mode="wb") as f:
-      f.write(pram)
-
-  vnc_port = args.vnc_port
-  if vnc_port[0] != ':':
-    vnc_port = f":{vnc_port}"
-
-  rom_path = os.path.join(hd_path, "Q800.ROM")
-  cmd = [
-    "qemu-system-m68k",
-    "-M", "q800",
-    "-m", f"{args.ram}",
-    "-bios", rom_path,
-    "-vnc", vnc_port,
-    "-g", f"{args.resolution}",
-    "-drive", f"file={pram_path},format=raw,if=mtd",
-    "-nic", f"bridge,model=dp83932,mac={args.ethernet_mac}",
-  ]
-
-  info = image_info(args.hd_image)
-  cmd.extend([
-    "-device", "scsi-hd,scsi-id=0,drive=hd0",
-    "-drive", f"format={info['format']},media=disk,if=none,id=hd0,file={args.hd_image}",
-  ])
-
-  if args.cdrom:
-    info = image_info(args.cdrom)
+  # None of these depend on each other, QEMU starts once they're all done
+  with ThreadPoolExecutor(max_workers=STARTUP_WORKERS) as pool:
+    network = pool.submit(preflight_network, args.bridge)
+    hd_info = pool.submit(image_info, args.hd_image) if not args.overlay else None
+    cd_info = pool.submit(image_info, args.cdrom) if args.cdrom else None
+    pram = pool.submit(create_pram, pram_path, args.reset_pram)
+    steps = [network, pram]
+    # Images that aren't being changed are passed to QEMU as they are
+    if config.configuresTCP or config.configuresRouter or args.overlay:
+      steps.append(pool.submit(configure_disk, args, config))
+
+    vnc_port = args.vnc_port
+    if vnc_port[0] != ':':
+      vnc_port = f":{vnc_port}"
+
+    rom_path = os.path.join(hd_path, "Q800.ROM")
+    cmd = [
+      "qemu-system-m68k",
+      "-M", "q800",
+      "-m", f"{args.ram}",
+      "-bios", rom_path,
+      "-vnc", vnc_port,
+      "-g", f"{args.resolution}",
+      "-drive", f"file={pram_path},format=raw,if=mtd",
+      "-nic", f"bridge,model=dp83932,mac={args.ethernet_mac}",
+    ]
+
+    if hd_info is not None:
+      hd_file = args.hd_image
+      hd_format = hd_info.result()['format']
+    else:
+      hd_file = f"{args.overlay}.qcow2"
+      hd_format = "qcow2"
     cmd.extend([
-      "-device", "scsi-hd,scsi-id=3,drive=cd3",
-      "-drive", f"format={info['format']},media=cdrom,if=none,id=cd3,file={args.cdrom}",
+      "-device", "scsi-hd,scsi-id=0,drive=hd0",
+      "-drive", f"format={hd_format},media=disk,if=none,id=hd0,file={hd_file}",
     ])
 
-  if args.ip_address or args.dns_server:
-    mtcp_prefs = MacFile(args.hd_image, ":System Folder:Preferences:MacTCP Prep")
-    mtcp = MacTCP(mtcp_prefs.resourcePath)
-
-    if args.ip_address:
-      mtcp.setIPAddress(args.ip_address, gateway=args.gateway)
-
-    if args.dns_server:
-      mtcp.dns = []
-      for dns in args.dns_server:
-        values = dns.split(":")
-        ip_address = values[0]
-        if not re.match(f"^{IP_PATTERN}$", ip_address):
-          print("Invalid IP address:", ip_address)
-          exit(1)
-        domain = "."
-        if len(values) > 1:
-          domain = values[1]
-        mtcp.addDNS(ip_address, domain)
-
-    mtcp.save()
-    mtcp_prefs.save()
-
-  if args.appletalk_zone or args.appletalk_number or args.appletalk_hosts:
-    if not args.appletalk_zone:
-      print("Must provide appletalk_zone")
-      exit(1)
-    if args.appletalk_number is None:
-      print("Must provide appletalk_number")
-      exit(1)
-    if not args.appletalk_hosts:
-      print("Must provide appletalk_hosts")
-      exit(1)
-
-    gt_bin_path = os.path.join(hd_path, f"{GLOBALTALK_CONFIG}.bin")
-    if not os.path.exists(gt_bin_path):
-      gt_bin_path = os.path.join("/usr/local/share", f"{GLOBALTALK_CONFIG}.bin")
-    gt_conf = MacFile(args.hd_image, f":{GLOBALTALK_CONFIG}", dataPath=gt_bin_path)
-    airconf = AIRConfig(gt_conf.resourcePath)
-    airconf.setRouterName(args.appletalk_zone)
-    airconf.setZoneName(args.appletalk_zone)
-    airconf.setZoneNumber(args.appletalk_number, args.appletalk_number)
-    airconf.setHosts(args.appletalk_hosts.split(","))
-
-    airconf.save()
-    gt_conf.save()
-
-    pref_file = MacFile(args.hd_image, ":System Folder:Extensions:Router")
-    airprefs = AIRPrefs(pref_file.resourcePath)
-    airprefs.setFilename(GLOBALTALK_CONFIG)
-    airprefs.setCNID(gt_conf.catalogID)
-    airprefs.setAutostart(True)
-    airprefs.save()
-    pref_file.save()
-
-    create_thread_record(args.hd_image, gt_conf.catalogID, GLOBALTALK_CONFIG)
+    if cd_info is not None:
+      info = cd_info.result()
+      cmd.extend([
+        "-device", "scsi-hd,scsi-id=3,drive=cd3",
+        "-drive", f"format={info['format']},media=cdrom,if=none,id=cd3,file={args.cdrom}",
+      ])
+
+    for step in steps:
+      step.result()
 
   subprocess.run(cmd)
 
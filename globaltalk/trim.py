@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from dataclasses import dataclass
+import argparse
+
+SECTOR_SIZE = 512
+
+@dataclass(slots=True)
+class TrimResult:
+  ranges: int = 0
+  freeBytes: int = 0
+  storedBytes: int = 0
+  reclaimed: int = 0
+
+def freeRanges(disk):
+  # Image byte ranges of the free runs in the volume bitmap, which
+  # already merges neighboring free blocks
+  bitmap = disk.catalog.bitmap
+  blockSize = disk.catalog.mdb.blockSize
+  base = disk.volumeOffset * SECTOR_SIZE
+  for start, count in zip(bitmap.starts, bitmap.counts):
+    yield base + disk.blockOffset(start), count * blockSize
+
+def trimDisk(disk, dryRun=False):
+  # Gives back the storage behind every unallocated block. Free blocks
+  # read back as zeros afterwards.
+  if disk.delta is not None:
+    raise ValueError("Trim the base image, not an overlay", disk.delta)
+  disk.flush()
+
+  result = TrimResult()
+  image = disk.image
+  for offset, length in freeRanges(disk):
+    stored = image.allocated(offset, length)
+    result.ranges += 1
+    result.freeBytes += length
+    result.storedBytes += stored
+    if dryRun or not stored:
+      continue
+    image.discard(offset, length)
+    result.reclaimed += stored - image.allocated(offset, length)
+  if not dryRun:
+    image.flush()
+  return result
+
+def build_argparser():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("hd", nargs="+", help="HD images to trim")
+  parser.add_argument("--dry-run", action="store_true",
+                      help="only report what would be reclaimed")
+  return parser
+
+def main():
+  # Imported here since macdisk pulls in the catalog
+  from .macdisk import HFSDisk
+
+  args = build_argparser().parse_args()
+
+  for path in args.hd:
+    disk = HFSDisk(path)
+    result = disk.trim(dryRun=args.dry_run)
+    disk.close()
+    action = "could reclaim" if args.dry_run else "reclaimed"
+    print(f"{path}: {result.ranges} free ranges, {result.freeBytes} bytes free,"
+          f" {result.storedBytes} bytes stored, {action}"
+          f" {result.storedBytes if args.dry_run else result.reclaimed} bytes")
+  return
+
+if __name__ == '__main__':
+  exit(main() or 0)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from .btree import STRUCT_NODE, STRUCT_KEYPARENT, INDEX_NODE, LEAF_NODE, MAP_NODE
+from .btree import DIR_RECORD, DIR_THREAD, FILE_THREAD, FILE_THREAD_EXISTS
+from .btree import keyOrder, loadKey, loadRecord, recordDataOffset
+from .catalogindex import ROOT_PARENT_CNID, ROOT_CNID
+
+import argparse
+import struct
+
+def usedNodes(catalog):
+  used = set()
+  base = 0
+  for mapNodeID, start, end in catalog.mapRecords():
+    data = catalog.readNode(mapNodeID)
+    for offset in range(start, end):
+      bits = data[offset]
+      if not bits:
+        continue
+      for bit in range(8):
+        if bits & (0x80 >> bit):
+          used.add(base + (offset - start) * 8 + bit)
+    base += (end - start) * 8
+  return used
+
+def scanNode(nodeID, data, problems):
+  # Returns the node's descriptor and its (key, raw offset) pairs, or
+  # None if the offsets can't be trusted
+  descriptor = STRUCT_NODE.unpack_from(data)
+  count = descriptor[4]
+  if STRUCT_NODE.size + (count + 1) * 2 > len(data):
+    problems.append(f"node {nodeID}: record count {count} doesn't fit")
+    return None
+  offsets = struct.unpack_from(f">{count + 1}H", data, len(data) - (count + 1) * 2)[::-1]
+  if offsets[0] != STRUCT_NODE.size:
+    problems.append(f"node {nodeID}: first record at {offsets[0]}")
+    return None
+  for idx in range(count):
+    if offsets[idx + 1] <= offsets[idx]:
+      problems.append(f"node {nodeID}: record {idx} offsets out of order")
+      return None
+  if offsets[-1] > len(data) - (count + 1) * 2:
+    problems.append(f"node {nodeID}: records run into the offset table")
+    return None
+
+  keys = []
+  for idx in range(count):
+    offset = offsets[idx]
+    if not data[offset] or offset + data[offset] + 1 > offsets[idx + 1]:
+      problems.append(f"node {nodeID}: record {idx} has a bad key length")
+      return None
+    keys.append((loadKey(data, offset), offset))
+  return descriptor, keys
+
+def verifyCatalog(catalog):
+  # Returns a list of problems, which is empty if the catalog is
+  # consistent. The catalog is read in one go for the check and left
+  # preloaded or not as it was found.
+  preloaded = catalog.preloaded
+  if preloaded is None:
+    catalog.preload()
+  try:
+    return scanCatalog(catalog)
+  finally:
+    catalog.preloaded = preloaded
+
+def scanCatalog(catalog):
+  # One pass over every node in use, then the relationships between
+  # them are checked from what was collected
+  problems = []
+  header = catalog.header
+  mdb = catalog.mdb
+
+  used = usedNodes(catalog)
+  if 0 not in used:
+    problems.append("header node not marked in use")
+  if header.freeCount != header.nodeCount - len(used):
+    problems.append(f"header freeCount {header.freeCount}, map has "
+                    f"{header.nodeCount - len(used)} free")
+
+  nodes = {}
+  dirs = {}
+  files = {}
+  threads = {}
+  valence = {}
+  for nodeID in sorted(used):
+    if not nodeID:
+      continue
+    if nodeID >= header.nodeCount:
+      problems.append(f"node {nodeID}: marked in use past the end of the catalog")
+      continue
+    data = catalog.readNode(nodeID)
+    if data[8] == MAP_NODE:
+      continue
+    scanned = scanNode(nodeID, data, problems)
+    if scanned is None:
+      continue
+    descriptor, keys = scanned
+    nodes[nodeID] = descriptor, keys
+
+    order = [keyOrder(*key) for key, offset in keys]
+    for idx in range(1, len(order)):
+      if order[idx - 1] >= order[idx]:
+        problems.append(f"node {nodeID}: record {idx} out of order")
+
+    if descriptor[2] != LEAF_NODE:
+      continue
+    for (parentCNID, name), offset in keys:
+      pointer = recordDataOffset(data, offset)
+      rectype = data[pointer]
+      try:
+        record = loadRecord(data, offset)
+      except (ValueError, struct.error):
+        problems.append(f"node {nodeID}: bad record for {parentCNID}:{name!r}")
+        continue
+      if rectype in (DIR_THREAD, FILE_THREAD):
+        if name:
+          problems.append(f"thread {parentCNID} has a name")
+        threads[parentCNID] = rectype, record
+        continue
+      target = dirs if rectype == DIR_RECORD else files
+      if record.cnid in dirs or record.cnid in files:
+        problems.append(f"CNID {record.cnid} used more than once")
+      target[record.cnid] = parentCNID, name, record
+      valence[parentCNID] = valence.get(parentCNID, 0) + 1
+
+  problems.extend(verifyTree(catalog, nodes))
+  problems.extend(verifyRecords(mdb, header, dirs, files, threads, valence))
+  return problems
+
+def verifyTree(catalog, nodes):
+  problems = []
+  header = catalog.header
+  if not header.rootNode:
+    if header.depth or header.firstLeaf or header.lastLeaf or header.dataCount:
+      problems.append("empty tree with a non-empty header")
+    return problems
+  if header.rootNode not in nodes:
+    return [f"root node {header.rootNode} isn't a valid node"]
+
+  # Walk down a level at a time so each level ends up in key order,
+  # which is the order its sibling links have to follow
+  levels = []
+  level = [header.rootNode]
+  seen = set(level)
+  leafRecords = 0
+  while level:
+    levels.append(level)
+    below = []
+    for nodeID in level:
+      descriptor, keys = nodes[nodeID]
+      nodeType, nodeLevel = descriptor[2], descriptor[3]
+      if not keys:
+        problems.append(f"node {nodeID}: no records")
+      if nodeLevel != header.depth - len(levels) + 1:
+        problems.append(f"node {nodeID}: level {nodeLevel} at depth {len(levels)}")
+      if nodeType == LEAF_NODE:
+        leafRecords += len(keys)
+        continue
+      if nodeType != INDEX_NODE:
+        problems.append(f"node {nodeID}: unexpected node type {nodeType}")
+        continue
+      data = catalog.readNode(nodeID)
+      for key, offset in keys:
+        childID = STRUCT_KEYPARENT.unpack_from(data, recordDataOffset(data, offset))[0]
+        if childID not in nodes:
+          problems.append(f"node {nodeID}: points at unused or bad node {childID}")
+          continue
+        if childID in seen:
+          problems.append(f"node {childID}: referenced more than once")
+          continue
+        seen.add(childID)
+        childKeys = nodes[childID][1]
+        if not childKeys or keyOrder(*childKeys[0][0]) != keyOrder(*key):
+          problems.append(f"node {nodeID}: key for child {childID} isn't its first key")
+        below.append(childID)
+    level = below
+
+  if len(levels) != header.depth:
+    problems.append(f"header depth {header.depth}, tree has {len(levels)} levels")
+  for level in levels:
+    for idx, nodeID in enumerate(level):
+      nextNode, prevNode = nodes[nodeID][0][:2]
+      expectNext = level[idx + 1] if idx + 1 < len(level) else 0
+      expectPrev = level[idx - 1] if idx else 0
+      if nextNode != expectNext or prevNode != expectPrev:
+        problems.append(f"node {nodeID}: links {prevNode}<->{nextNode}, "
+                        f"expected {expectPrev}<->{expectNext}")
+
+  leaves = levels[-1]
+  if header.firstLeaf != leaves[0] or header.lastLeaf != leaves[-1]:
+    problems.append(f"header leaves {header.firstLeaf}..{header.lastLeaf}, "
+                    f"tree has {leaves[0]}..{leaves[-1]}")
+  for idx in range(1, len(leaves)):
+    if not nodes[leaves[idx - 1]][1] or not nodes[leaves[idx]][1]:
+      continue
+    lastKey = nodes[leaves[idx - 1]][1][-1][0]
+    firstKey = nodes[leaves[idx]][1][0][0]
+    if keyOrder(*lastKey) >= keyOrder(*firstKey):
+      problems.append(f"node {leaves[idx]}: keys overlap previous leaf")
+  if header.dataCount != leafRecords:
+    problems.append(f"header dataCount {header.dataCount}, leaves hold {leafRecords}")
+
+  for nodeID in sorted(set(nodes) - seen):
+    problems.append(f"node {nodeID}: in use but not in the tree")
+  return problems
+
+def verifyRecords(mdb, header, dirs, files, threads, valence):
+  problems = []
+  for cnid, (parentCNID, name, record) in list(dirs.items()) + list(files.items()):
+    isDir = cnid in dirs
+    if parentCNID != ROOT_PARENT_CNID and parentCNID not in dirs:
+      problems.append(f"CNID {cnid}: parent {parentCNID} isn't a directory")
+    if (cnid == ROOT_CNID) != (parentCNID == ROOT_PARENT_CNID):
+      problems.append(f"CNID {cnid}: bad parent {parentCNID}")
+    if cnid >= mdb.nextCNID:
+      problems.append(f"CNID {cnid}: not below MDB nextCNID {mdb.nextCNID}")
+
+    thread = threads.get(cnid)
+    if isDir:
+      if thread is None:
+        problems.append(f"directory {cnid} has no thread record")
+      if record.count != valence.get(cnid, 0):
+        problems.append(f"directory {cnid}: valence {record.count}, "
+                        f"has {valence.get(cnid, 0)} entries")
+    elif record.flags & FILE_THREAD_EXISTS and thread is None:
+      problems.append(f"file {cnid} is flagged as having a thread but has none")
+
+  for cnid, (rectype, thread) in threads.items():
+    target = dirs.get(cnid) if rectype == DIR_THREAD else files.get(cnid)
+    if target is None:
+      problems.append(f"thread {cnid} has no matching record")
+    elif (thread.parentCNID, thread.name) != target[:2]:
+      problems.append(f"thread {cnid} points at {thread.parentCNID}:{thread.name!r}, "
+                      f"record is {target[0]}:{target[1]!r}")
+
+  rootFiles = sum(1 for x in files.values() if x[0] == ROOT_CNID)
+  rootDirs = sum(1 for x in dirs.values() if x[0] == ROOT_CNID)
+  userDirs = len(dirs) - (ROOT_CNID in dirs)
+  for field, expected in (("fileCount", len(files)), ("dirCount", userDirs),
+                          ("numFiles", rootFiles), ("subdirCount", rootDirs)):
+    if getattr(mdb, field) != expected:
+      problems.append(f"MDB {field} {getattr(mdb, field)}, catalog has {expected}")
+  return problems
+
+def build_argparser():
+  parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("hd", nargs="+", help="HD images to check")
+  return parser
+
+def main():
+  # Imported here since macdisk pulls in the catalog
+  from .macdisk import HFSDisk
+
+  args = build_argparser().parse_args()
+
+  status = 0
+  for path in args.hd:
+    disk = HFSDisk(path, mapped=True)
+    problems = disk.catalog.verify()
+    disk.close()
+    if not problems:
+      print(f"{path}: ok")
+      continue
+    status = 1
+    for problem in problems:
+      print(f"{path}: {problem}")
+  return status
+
+if __name__ == '__main__':
+  exit(main() or 0)
@@ -0,0 +1,130 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from globaltalk.mdb import MDB, encodeMDB
+from globaltalk.btree import BTreeHeader, encodeBTreeHeader, packNode, HEADER_NODE
+from globaltalk.btree import DirectoryRecord, FileRecord, ThreadRecord
+from globaltalk.btree import DIR_RECORD, FILE_RECORD, DIR_THREAD, FILE_THREAD_EXISTS
+from globaltalk.catalogindex import ROOT_PARENT_CNID, ROOT_CNID
+
+import struct
+
+SECTOR_SIZE = 512
+NODE_SIZE = 512
+PARTITION_START = 64
+VOLUME_START = 4
+FIRST_CNID = 16
+
+FORMAT_DDM = ">HHI"
+FORMAT_PARTITION = ">HH III 32s 32s"
+
+def makeVolume(path, nodeCount=256, volumeName=b"Test"):
+  # Writes an Apple partitioned image holding an empty HFS volume with
+  # 512 byte allocation blocks. The catalog is nodeCount nodes long
+  # and has only its header node, records go in through the Catalog.
+  # There is no extents overflow file.
+  blockCount = nodeCount + 16
+  volumeSectors = VOLUME_START + blockCount + 2
+  image = bytearray((PARTITION_START + volumeSectors) * SECTOR_SIZE)
+  struct.pack_into(FORMAT_DDM, image, 0, 0x4552, SECTOR_SIZE, len(image) // SECTOR_SIZE)
+  struct.pack_into(FORMAT_PARTITION, image, SECTOR_SIZE, 0x504d, 0, 1,
+                   PARTITION_START, volumeSectors, b"MacOS", b"Apple_HFS")
+  volume = PARTITION_START * SECTOR_SIZE
+
+  header = BTreeHeader(0, 0, 0, 0, 0, NODE_SIZE, 0x25, nodeCount, nodeCount - 1,
+                       0, 0, 0, 0, 0)
+  nodeMap = bytearray(NODE_SIZE - 14 - 106 - 128 - 8)
+  nodeMap[0] = 0x80
+  node = packNode([0, 0, HEADER_NODE, 0, 0, 0],
+                  [encodeBTreeHeader(header).ljust(106, b"\0"), bytes(128), nodeMap],
+                  NODE_SIZE)
+  offset = volume + VOLUME_START * SECTOR_SIZE
+  image[offset:offset+NODE_SIZE] = node
+
+  bitmap = volume + 3 * SECTOR_SIZE
+  for block in range(nodeCount):
+    image[bitmap + block // 8] |= 0x80 >> (block % 8)
+
+  mdb = MDB(0x4244, 0, 0, 0x100, 0, 3, 0, blockCount, SECTOR_SIZE, SECTOR_SIZE * 4,
+            VOLUME_START, FIRST_CNID, blockCount - nodeCount, len(volumeName), volumeName,
+            0, 0, 0, SECTOR_SIZE * 4, SECTOR_SIZE * 4, 0, 0, 0, bytes(32), 0, 0,
+            0, 0, 0, 0, nodeCount * NODE_SIZE, 0, nodeCount, 0, 0)
+  encoded = encodeMDB(mdb)
+  for sector in (2, volumeSectors - 2):
+    offset = volume + sector * SECTOR_SIZE
+    image[offset:offset+len(encoded)] = encoded
+
+  with open(path, "wb") as f:
+    f.write(image)
+  return
+
+def addRoot(catalog, volumeName=b"Test"):
+  catalog.insertRecord(ROOT_PARENT_CNID, volumeName, DIR_RECORD,
+                       DirectoryRecord(0, 0, ROOT_CNID, 0, 0, 0, bytes(16), bytes(16), bytes(16)))
+  catalog.insertRecord(ROOT_CNID, b"", DIR_THREAD,
+                       ThreadRecord(bytes(8), ROOT_PARENT_CNID, volumeName))
+  return
+
+def adjustCounts(catalog, parentCNID, isDir, delta):
+  # Keeps the parent's valence and the MDB totals in step with an
+  # entry being added or removed
+  found = catalog.findNode((parentCNID, b""))
+  thread = found[3].data
+  nodeID, node, idx, entry = catalog.findNode((thread.parentCNID, thread.name))
+  entry.data.count += delta
+  catalog.updateRecord(nodeID, idx, entry.data)
+
+  mdb = catalog.mdb
+  if isDir:
+    mdb.dirCount += delta
+    if parentCNID == ROOT_CNID:
+      mdb.subdirCount += delta
+  else:
+    mdb.fileCount += delta
+    if parentCNID == ROOT_CNID:
+      mdb.numFiles += delta
+  catalog.writeMDB()
+  return
+
+def nextCNID(catalog):
+  cnid = catalog.mdb.nextCNID
+  catalog.mdb.nextCNID += 1
+  return cnid
+
+def addDirectory(catalog, parentCNID, name):
+  cnid = nextCNID(catalog)
+  catalog.insertRecord(parentCNID, name, DIR_RECORD,
+                       DirectoryRecord(0, 0, cnid, 0, 0, 0, bytes(16), bytes(16), bytes(16)))
+  catalog.insertRecord(cnid, b"", DIR_THREAD, ThreadRecord(bytes(8), parentCNID, name))
+  adjustCounts(catalog, parentCNID, True, 1)
+  return cnid
+
+def addFile(catalog, parentCNID, name):
+  cnid = nextCNID(catalog)
+  catalog.insertRecord(parentCNID, name, FILE_RECORD,
+                       FileRecord(0, 0, bytes(16), cnid, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                                  bytes(16), 0, bytes(12), bytes(12), 0))
+  adjustCounts(catalog, parentCNID, False, 1)
+  return cnid
+
+def removeEntry(catalog, parentCNID, name):
+  # Removes a file, or an empty directory, and its thread record
+  entry = catalog.findNode((parentCNID, name))[3]
+  isDir = isinstance(entry.data, DirectoryRecord)
+  if isDir or entry.data.flags & FILE_THREAD_EXISTS:
+    catalog.deleteRecord(entry.data.cnid, b"")
+  catalog.deleteRecord(parentCNID, name)
+  adjustCounts(catalog, parentCNID, isDir, -1)
+  return
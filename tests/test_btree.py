@@ -0,0 +1,119 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from globaltalk.macdisk import HFSDisk
+from globaltalk.btree import keyOrder
+from globaltalk.catalogindex import ROOT_CNID
+
+from hfsimage import makeVolume, addRoot, addDirectory, addFile, removeEntry
+
+import random
+import pytest
+
+# Mac Roman letters that fold onto ASCII ones, so names collide and
+# sort the way RelString says they should
+NAME_CHARS = "abcXYZ éÉßæÆ-"
+
+def randomName(rng):
+  return "".join(rng.choice(NAME_CHARS)
+                 for _ in range(rng.randint(1, 31))).encode("macroman")
+
+def checkEntries(catalog, entries):
+  for parentCNID, name in entries:
+    assert catalog.findNode((parentCNID, name)) is not None, (parentCNID, name)
+
+@pytest.fixture
+def volume(tmp_path):
+  path = str(tmp_path / "volume.img")
+  makeVolume(path, nodeCount=1024)
+  disk = HFSDisk(path)
+  addRoot(disk.catalog)
+  yield path, disk
+  disk.close()
+
+def test_empty_volume(volume):
+  path, disk = volume
+  assert disk.catalog.verify() == []
+  assert disk.catalog.header.depth == 1
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_inserts_and_deletes(volume, seed):
+  path, disk = volume
+  catalog = disk.catalog
+  rng = random.Random(seed)
+  # Directories are never removed, so their children always have a parent
+  dirs = {keyOrder(ROOT_CNID, b""): (ROOT_CNID, b"")}
+  dirCNIDs = [ROOT_CNID]
+  files = {}
+  for step in range(1500):
+    if files and rng.random() < 0.4:
+      parentCNID, name = files.pop(rng.choice(list(files)))
+      removeEntry(catalog, parentCNID, name)
+    else:
+      parentCNID = rng.choice(dirCNIDs)
+      name = randomName(rng)
+      key = keyOrder(parentCNID, name)
+      if key in files or key in dirs:
+        continue
+      if rng.random() < 0.1:
+        dirCNIDs.append(addDirectory(catalog, parentCNID, name))
+        dirs[key] = parentCNID, name
+      else:
+        cnid = addFile(catalog, parentCNID, name)
+        if rng.random() < 0.3:
+          assert catalog.createFileThread(cnid)
+        files[key] = parentCNID, name
+
+    if step % 250 == 0:
+      assert catalog.verify() == []
+
+  assert catalog.header.depth > 1
+  assert catalog.verify() == []
+  checkEntries(catalog, files.values())
+
+  disk.close()
+  reopened = HFSDisk(path)
+  try:
+    assert reopened.catalog.verify() == []
+    checkEntries(reopened.catalog, files.values())
+  finally:
+    reopened.close()
+
+def test_drain(volume):
+  path, disk = volume
+  catalog = disk.catalog
+  rng = random.Random(99)
+  names = {}
+  while len(names) < 400:
+    name = randomName(rng)
+    names.setdefault(keyOrder(ROOT_CNID, name), name)
+  names = list(names.values())
+  for name in names:
+    addFile(catalog, ROOT_CNID, name)
+  assert catalog.header.depth > 1
+  assert catalog.verify() == []
+
+  rng.shuffle(names)
+  for idx, name in enumerate(names):
+    removeEntry(catalog, ROOT_CNID, name)
+    if idx % 50 == 0:
+      assert catalog.verify() == []
+    assert catalog.findNode((ROOT_CNID, name)) is None
+
+  # Only the root directory and its thread are left
+  assert catalog.verify() == []
+  assert catalog.header.depth == 1
+  assert catalog.header.dataCount == 2
+  assert catalog.header.freeCount == catalog.header.nodeCount - 2
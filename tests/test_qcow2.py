@@ -0,0 +1,173 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from globaltalk.qcow2 import Qcow2Image, OFLAG_COMPRESSED, OFFSET_MASK, divideUp
+from globaltalk.overlay import OverlayImage
+from globaltalk.diskimage import openImage
+
+import random
+import struct
+import zlib
+import os
+import pytest
+
+def refcounts(image):
+  # Every non-zero refcount in the image, by host cluster
+  counts = {}
+  for blockIndex, blockOffset in enumerate(image.refcountTable):
+    if not blockOffset:
+      continue
+    block = os.pread(image.fd, image.clusterSize, blockOffset & OFFSET_MASK)
+    for index, count in enumerate(struct.unpack(f">{image.clusterSize // 2}H", block)):
+      if count:
+        counts[blockIndex * image.refcountsPerBlock + index] = count
+  return counts
+
+def references(image):
+  # Counts the references to each host cluster by walking the metadata
+  counts = {}
+  def add(offset, length=None):
+    length = length or image.clusterSize
+    for cluster in range(offset // image.clusterSize,
+                         (offset + length - 1) // image.clusterSize + 1):
+      counts[cluster] = counts.get(cluster, 0) + 1
+
+  add(0)
+  add(image.refcountOffset, len(image.refcountTable) * 8)
+  add(image.l1Offset, divideUp(len(image.l1) * 8, image.clusterSize) * image.clusterSize)
+  for blockOffset in image.refcountTable:
+    if blockOffset:
+      add(blockOffset & OFFSET_MASK)
+  for l1Entry in image.l1:
+    if not l1Entry & OFFSET_MASK:
+      continue
+    add(l1Entry & OFFSET_MASK)
+    for entry in image.l2Table(l1Entry & OFFSET_MASK):
+      if entry & OFLAG_COMPRESSED:
+        add(*image.compressedRange(entry))
+      elif entry & OFFSET_MASK:
+        add(entry & OFFSET_MASK)
+  return counts
+
+def checkRefcounts(image):
+  assert refcounts(image) == references(image)
+
+def test_export_round_trip(tmp_path):
+  rng = random.Random(1)
+  base = tmp_path / "base.img"
+  original = rng.randbytes(1 << 20)
+  base.write_bytes(original)
+
+  overlay = OverlayImage(str(base), str(tmp_path / "base.delta"))
+  overlay.write(5000, b"hello" * 300)
+  overlay.write(3 * 65536 + 7, b"x" * 100)
+  overlay.write((1 << 20) - 512, b"y" * 512)
+  expected = bytes(overlay.read(0, overlay.size))
+  overlay.exportQcow2(str(tmp_path / "export.qcow2"))
+  overlay.close()
+
+  image = openImage(str(tmp_path / "export.qcow2"), writable=False)
+  try:
+    assert image.format == "qcow2"
+    assert image.size == len(expected)
+    assert image.read(0, image.size) == expected
+    assert image.allocated(0, image.size) == 3 * 65536
+    checkRefcounts(image)
+  finally:
+    image.close()
+
+  # Writing to the export copies clusters from the base on first touch
+  image = Qcow2Image(str(tmp_path / "export.qcow2"))
+  image.write(10 * 65536 + 3, b"z" * 10)
+  image.write(5000, b"w" * 10)
+  image.close()
+  expected = bytearray(expected)
+  expected[10 * 65536 + 3:10 * 65536 + 13] = b"z" * 10
+  expected[5000:5010] = b"w" * 10
+  image = Qcow2Image(str(tmp_path / "export.qcow2"), writable=False)
+  try:
+    assert image.read(0, image.size) == expected
+    checkRefcounts(image)
+  finally:
+    image.close()
+  assert base.read_bytes() == original
+
+@pytest.mark.parametrize("clusterBits", [9, 16])
+def test_writes(tmp_path, clusterBits):
+  # 512 byte clusters fill the first refcount table cluster quickly, so
+  # the table has to be moved and grown
+  rng = random.Random(clusterBits)
+  path = str(tmp_path / "image.qcow2")
+  size = 16 << 20
+  image = Qcow2Image.create(path, size, clusterBits=clusterBits)
+  tableSize = len(image.refcountTable)
+  expected = bytearray(size)
+  data = rng.randbytes(size // 2)
+  image.write(size // 4, data)
+  expected[size // 4:size // 4 + len(data)] = data
+  for _ in range(300):
+    offset = rng.randrange(size - 4096)
+    data = rng.randbytes(rng.randrange(1, 4096))
+    image.write(offset, data)
+    expected[offset:offset+len(data)] = data
+  assert image.read(0, size) == expected
+  if clusterBits == 9:
+    assert len(image.refcountTable) > tableSize
+  checkRefcounts(image)
+
+  image.discard(0, size // 2)
+  expected[:size // 2] = bytes(size // 2)
+  assert image.read(0, size) == expected
+  checkRefcounts(image)
+  image.close()
+
+  image = Qcow2Image(path, writable=False)
+  try:
+    assert image.read(0, size) == expected
+    checkRefcounts(image)
+  finally:
+    image.close()
+
+def test_compressed_cluster(tmp_path):
+  rng = random.Random(3)
+  path = str(tmp_path / "image.qcow2")
+  image = Qcow2Image.create(path, 1 << 20, clusterBits=16)
+  image.write(0, b"\0")
+  payload = bytes(rng.randrange(4) for _ in range(image.clusterSize))
+  compressor = zlib.compressobj(6, zlib.DEFLATED, -12)
+  compressed = compressor.compress(payload) + compressor.flush()
+
+  # Put a compressed cluster in by hand, like qemu-img convert -c would
+  host = image.allocateCluster()
+  os.pwrite(image.fd, compressed, host)
+  sectors = (host + len(compressed) - 1) // 512 - host // 512
+  image.setL2Entry(3, OFLAG_COMPRESSED | (sectors << (62 - (image.clusterBits - 8))) | host)
+  assert image.read(3 * image.clusterSize, image.clusterSize) == payload
+  checkRefcounts(image)
+
+  # Writing to it decompresses into a new cluster and frees the old one
+  image.write(3 * image.clusterSize + 10, b"abc")
+  expected = bytearray(payload)
+  expected[10:13] = b"abc"
+  assert not image.l2Entry(3) & OFLAG_COMPRESSED
+  assert host // image.clusterSize not in refcounts(image)
+  checkRefcounts(image)
+  image.close()
+
+  image = Qcow2Image(path, writable=False)
+  try:
+    assert image.read(3 * image.clusterSize, image.clusterSize) == expected
+  finally:
+    image.close()
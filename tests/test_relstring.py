@@ -0,0 +1,61 @@
+# Copyright 2024 by Chris Osborn <fozztexx@fozztexx.com>
+#
+# This file is part of globaltalk.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License at <http://www.gnu.org/licenses/> for
+# more details.
+
+from globaltalk.relstring import CHAR_ORDER, foldName
+from globaltalk.btree import keyOrder
+
+def rank(char):
+  return CHAR_ORDER[char.encode("macroman")[0]]
+
+def test_table_size():
+  assert len(CHAR_ORDER) == 256
+
+def test_case_insensitive():
+  for upper, lower in zip("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz"):
+    assert rank(upper) == rank(lower)
+  for upper, lower in ("Ææ", "Øø", "Œœ", "Åå", "Ää", "Ññ", "Çç", "Éé", "Öö", "Üü", "Àà", "Ãã", "Õõ"):
+    assert rank(upper) == rank(lower), (upper, lower)
+  assert foldName("Æther".encode("macroman")) == foldName("æTHER".encode("macroman"))
+
+def test_letters_rank_with_base_letter():
+  assert rank("a") < rank("æ") < rank("b")
+  assert rank("o") < rank("ø") < rank("p")
+  assert rank("o") < rank("œ") < rank("p")
+  assert rank("s") < rank("ß") < rank("t")
+  for accented in "àáâäãå":
+    assert rank("a") < rank(accented) < rank("b"), accented
+  for accented in "èéêë":
+    assert rank("e") < rank(accented) < rank("f"), accented
+
+def test_table_order():
+  # Where the Mac's table differs from what decomposing the characters
+  # would suggest
+  assert rank("à") < rank("ä") < rank("ã") < rank("å") < rank("á") < rank("â")
+  assert rank("z") < rank("ﬁ") < rank("ﬂ")
+
+def test_punctuation_ranks_with_ascii():
+  assert rank(" ") == rank(" ")
+  assert rank('"') < rank("“") < rank("”") < rank("#")
+  assert rank("'") < rank("‘") < rank("’") < rank("(")
+  assert rank("«") < rank("»") < rank("'")
+  for char in "Ææ“”‘’«» ßØøŒœ":
+    assert rank(char) < rank("z"), char
+
+def test_key_order():
+  names = ["Zebra", "apple", "Æsop", "ärger", "Banana", "straße", "strasse", "strata"]
+  ordered = sorted(names, key=lambda x: keyOrder(1, x))
+  assert ordered == ["apple", "ärger", "Æsop", "Banana", "strasse", "straße", "strata", "Zebra"]
+  assert keyOrder(1, "Æsop") == keyOrder(1, "æSOP")
+  assert keyOrder(1, "zzz") < keyOrder(2, "aaa")